@@ -6,38 +6,797 @@ import os
 import sys
 import time
 import getpass
-import subprocess
 import shlex
-import urllib.request
-import hashlib
-import json
 import io
 from functools import wraps
-import difflib
+import functools
+import threading
+import queue
+import atexit
+import mmap
+import bisect
+import random
+import math
+import collections
+import itertools
+import codecs
+# Heavier modules (consoleiotools, urllib, subprocess, asyncio, json, hashlib, ...) are imported inside the functions using them, to keep `import KyanToolKit` fast.
 
-import consoleiotools as cit
+
+class TraceWriter(object):
+    """Append trace records to a file in batches from a background thread.
+
+    Records are queued in memory and written by a daemon thread, so callers never wait on file I/O (unless the queue is full and `on_full` is 'block'). Pending records are flushed on `flush()`, `close()` and at interpreter exit. Records written after `close()` are appended directly.
+
+    Args:
+        trace_file: str. The file records are appended to.
+        queue_size: int. Max number of records waiting in memory. Default is 10000.
+        on_full: str. 'block' waits for room when the queue is full, 'drop' discards the record and counts it in `dropped`. Default is 'block'.
+        batch_size: int. Max number of records written per file open. Default is 1000.
+        max_bytes: int. Rotate the trace file when it would grow beyond this size. Default is 0, never rotate.
+        backup_count: int. Number of rotated files kept, as `trace_file.1` ... `trace_file.N`. Default is 5.
+        encoding: str. Encoding of the trace file. Default is None, the locale encoding.
+    """
+    _STOP = object()  # sentinel to stop the writer thread
+
+    def __init__(self, trace_file, queue_size=10000, on_full='block', batch_size=1000, max_bytes=0, backup_count=5, encoding=None):
+        if on_full not in ('block', 'drop'):
+            raise ValueError("invalid on_full '{}' (block/drop)".format(on_full))
+        self.trace_file = trace_file
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.encoding = encoding
+        self.on_full = on_full
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.error = None  # last exception raised while writing
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="TraceWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: str):
+        """Queue a record. Returns False if it was dropped."""
+        if self._closed:  # e.g. from atexit handlers or daemon threads after the exit flush
+            self._appendNow(record)
+            return True
+        if self.on_full == 'block':
+            self._queue.put(record)
+            return True
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def flush(self):
+        """Block until every queued record is written"""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        """Flush pending records and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+        while True:  # records queued while closing
+            try:
+                self._appendNow(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _appendNow(self, record: str):
+        try:
+            with self._lock:
+                self.append(self.trace_file, record, self.max_bytes, self.backup_count, self.encoding)
+        except Exception as e:
+            self.error = e
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [r for r in batch if r is not self._STOP]
+            try:
+                if records:
+                    self.append(self.trace_file, ''.join(records), self.max_bytes, self.backup_count, self.encoding)
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if len(records) != len(batch):
+                return
+
+    @staticmethod
+    def append(trace_file, data: str, max_bytes=0, backup_count=5, encoding=None):
+        """Append data to trace_file, rotating it first if it would grow beyond max_bytes"""
+        if max_bytes and os.path.exists(trace_file):
+            size = os.path.getsize(trace_file)
+            if size and size + len(data) > max_bytes:
+                for i in range(backup_count - 1, 0, -1):
+                    if os.path.exists("{}.{}".format(trace_file, i)):
+                        os.replace("{}.{}".format(trace_file, i), "{}.{}".format(trace_file, i + 1))
+                if backup_count > 0:
+                    os.replace(trace_file, trace_file + ".1")
+                else:
+                    os.remove(trace_file)
+        with open(trace_file, 'a', encoding=encoding) as trace:
+            trace.write(data)
+
+
+class TraceReader(object):
+    """Query a JSONL trace file through a sidecar index.
+
+    The index (`trace_file.idx`) keeps the offset, length, timestamp and function name of every record. It is built on first use, extended when the trace file grows and rebuilt when the file is replaced. Matching records are read straight from a memory-mapped trace file.
+
+    Args:
+        trace_file: str. A trace file written with `trace_format='jsonl'`.
+    """
+    def __init__(self, trace_file):
+        self.trace_file = trace_file
+        self.index_file = trace_file + ".idx"
+        self._records = []  # [offset, length, ts, func]
+        self._times = []
+        self._funcs = {}
+        self._stat = None
+
+    def index(self):
+        """Load, extend or rebuild the index. Returns the number of indexed records."""
+        import hashlib
+        import json
+        st = os.stat(self.trace_file)
+        stat = (st.st_size, st.st_mtime_ns)
+        if stat == self._stat:
+            return len(self._records)
+        saved = None
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, encoding='utf-8') as f:
+                    saved = json.load(f)
+            except ValueError:
+                saved = None
+        with open(self.trace_file, 'rb') as f:
+            head = f.readline()
+        head_md5 = hashlib.md5(head).hexdigest()
+        if saved and saved['head'] == head_md5 and saved['size'] <= st.st_size:
+            records, start = saved['records'], saved['size']
+        else:
+            records, start = [], 0
+        if start < st.st_size:
+            new_records, end = self._scan(start)
+            if new_records or end != start:
+                records.extend(new_records)
+                with open(self.index_file, 'w', encoding='utf-8') as f:
+                    json.dump({'size': end, 'head': head_md5, 'records': records}, f)
+        self._records = records
+        self._times = [r[2] for r in records]
+        self._funcs = {}
+        for i, r in enumerate(records):
+            self._funcs.setdefault(r[3], []).append(i)
+        self._stat = stat
+        return len(records)
+
+    def _scan(self, start: int) -> (list, int):
+        """Index the complete lines after `start`. Returns the new records and where the scan stopped."""
+        import json
+        records = []
+        with open(self.trace_file, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # the last record is still being written
+                if line.strip():
+                    try:
+                        rec = json.loads(line)
+                        records.append([offset, len(line), rec.get('ts', 0), rec.get('func', '')])
+                    except ValueError:
+                        pass  # partial or broken line
+                offset += len(line)
+        return records, offset
+
+    def query(self, func=None, start=None, end=None):
+        """Yield records matching all the given conditions.
+
+        Args:
+            func: str. Name of the function which called TRACE().
+            start: float. Records at or after this timestamp (as `time.time()`).
+            end: float. Records before this timestamp.
+
+        Yields:
+            dict: The decoded trace records, in file order. Time ranges assume records are written in time order.
+        """
+        import json
+        self.index()
+        if not self._records:
+            return
+        lo = bisect.bisect_left(self._times, start) if start is not None else 0
+        hi = bisect.bisect_left(self._times, end) if end is not None else len(self._records)
+        if func is not None:
+            positions = self._funcs.get(func, [])
+            positions = positions[bisect.bisect_left(positions, lo):bisect.bisect_left(positions, hi)]
+        else:
+            positions = range(lo, hi)
+        with open(self.trace_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for i in positions:
+                    offset, length = self._records[i][:2]
+                    yield json.loads(mm[offset:offset + length])
+
+
+class LRUCache(object):
+    """A size-bounded least-recently-used mapping, optionally persisted as a JSON file.
+
+    Keys are strings and values must be JSON serializable when `path` is set. Thread-safe.
+
+    Args:
+        maxsize: int. Max number of entries, the least recently used ones are evicted first. Default is 10000.
+        path: str. JSON file loaded on init and written by save(). Default is None, memory only.
+    """
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key: str, default=None, check: callable = None):
+        """Get a value and mark it as recently used.
+
+        Args:
+            key: str.
+            default: Returned on miss. Default is None.
+            check: callable. Optional `check(value) -> bool`. Values failing the check are dropped and count as a miss.
+        """
+        with self._lock:
+            value = self._data.get(key, self)
+            if value is not self and (check is None or check(value)):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            if value is not self:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: str, value):
+        """Add or replace a value, evicting the least recently used entries beyond maxsize"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: str, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Returns: dict: size, hits, misses and evictions"""
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def load(self):
+        """Replace the entries with the ones saved in `path`"""
+        import json
+        with open(self.path, encoding='utf-8') as f:
+            items = json.load(f)
+        with self._lock:
+            self._data = collections.OrderedDict(items[-self.maxsize:] if self.maxsize else [])
+
+    def save(self):
+        """Write the entries into `path`, atomically"""
+        import json
+        import tempfile
+        with self._lock:
+            items = list(self._data.items())
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.ktk-cache-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(items, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+class HashCache(LRUCache):
+    """Remember file digests by (path, size, mtime_ns, inode), so unchanged files are never read again.
+
+    Use it through `KyanToolKit.hashFile(..., cache=cache)` or `hashFiles(..., cache=cache)`, and call save() to keep it for the next run.
+
+    Args:
+        path: str. JSON file to keep the cache in. Default is None, memory only.
+        maxsize: int. Max number of files remembered. Default is 100000.
+    """
+    def __init__(self, path=None, maxsize=100000):
+        super().__init__(maxsize=maxsize, path=path)
+
+    def hashFile(self, file_: str, algorithm='md5', **kwargs) -> str:
+        """Same as `KyanToolKit.hashFile()`, but only reads files whose metadata changed"""
+        st = os.stat(file_)
+        meta = [st.st_size, st.st_mtime_ns, st.st_ino]
+        key = algorithm + ":" + os.path.abspath(file_)
+        entry = self.get(key, check=lambda e: e[0] == meta)
+        if entry:
+            return entry[1]
+        digest = KyanToolKit.hashFile(file_, algorithm, **kwargs)
+        self.put(key, [meta, digest])
+        return digest
+
+
+class ImageColorCache(LRUCache):
+    """Remember imageToColor() results, so repeated images skip the download and PIL.
+
+    Results are keyed on (url, scale, mode) and on the md5 of the image content, so the same image behind different urls is decoded only once.
+
+    Args:
+        path: str. JSON file to keep the cache in. Default is None, memory only.
+        maxsize: int. Max number of entries. Default is 1024.
+    """
+    def __init__(self, path=None, maxsize=1024):
+        super().__init__(maxsize=maxsize, path=path)
+
+    @staticmethod
+    def urlKey(url: str, scale: int, mode: str) -> str:
+        return "url:{}:{}:{}".format(scale, mode.lower(), url)
+
+    @staticmethod
+    def contentKey(digest: str, scale: int, mode: str) -> str:
+        return "md5:{}:{}:{}".format(scale, mode.lower(), digest)
+
+
+class CmdIndex(object):
+    """Names of the executables in PATH, looked up without spawning a shell.
+
+    The index is built on first lookup and rebuilt when PATH (or PATHEXT on Windows) or the mtime of any PATH directory changes. Shell builtins, aliases and functions are not included.
+    """
+    def __init__(self):
+        self.windows = sys.platform.startswith('win')
+        self._state = None
+        self._names = frozenset()
+        self._lock = threading.Lock()
+
+    def _pathExts(self) -> list:
+        return [ext.lower() for ext in os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(';') if ext]
+
+    def refresh(self):
+        """Rebuild the index if PATH has changed since last time"""
+        path = os.environ.get('PATH', os.defpath)
+        dirs = [d for d in path.split(os.pathsep) if d]
+        mtimes = []
+        for d in dirs:
+            try:
+                mtimes.append(os.stat(d).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        state = (path, os.environ.get('PATHEXT', ''), tuple(mtimes))
+        if state == self._state:
+            return
+        with self._lock:
+            names = set()
+            exts = self._pathExts()
+            for d in dirs:
+                try:
+                    with os.scandir(d) as entries:
+                        for entry in entries:
+                            if self.windows:
+                                name = entry.name.lower()
+                                if os.path.splitext(name)[1] in exts:
+                                    names.add(name)
+                                    names.add(os.path.splitext(name)[0])
+                            elif entry.is_file() and os.access(entry.path, os.X_OK):
+                                names.add(entry.name)
+                except OSError:
+                    continue  # missing or unreadable PATH entry
+            self._names = frozenset(names)
+            self._state = state
+
+    def _lookup(self, cmd: str) -> bool:
+        if os.path.dirname(cmd):  # a path, not a name
+            candidates = [cmd] + ([cmd + ext for ext in self._pathExts()] if self.windows else [])
+            return any(os.path.isfile(c) and os.access(c, os.X_OK) for c in candidates)
+        return (cmd.lower() if self.windows else cmd) in self._names
+
+    def has(self, cmd: str) -> bool:
+        self.refresh()
+        return self._lookup(cmd)
+
+    def hasAll(self, cmds) -> dict:
+        self.refresh()
+        return {cmd: self._lookup(cmd) for cmd in cmds}
+
+
+HttpResponse = collections.namedtuple('HttpResponse', ['status', 'headers', 'body'])  # returned by HttpSession.request()
+
+
+class HttpSession(object):
+    """Keep-alive HTTP(S) connections pooled per host, shared by requests.
+
+    Set `KyanToolKit.http_session = HttpSession()` to make every ajax() call use it, or pass it as `session=`. Thread-safe.
+
+    Args:
+        max_per_host: int. Max idle connections kept per host. Default is 4.
+        idle_timeout: float. Seconds an idle connection is kept before closed. Default is 30.
+        timeout: float. Socket timeout of connecting and reading, in seconds. Default is 10.
+        gzip: bool. Ask servers for gzip responses and decompress them. Default is True.
+    """
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+    def __init__(self, max_per_host=4, idle_timeout=30, timeout=10, gzip=True):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.gzip = gzip
+        self._pools = {}  # (scheme, host, port): deque of (connection, last used time)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _acquire(self, key):
+        """Returns (connection, is_reused)"""
+        import http.client
+        import select
+        now = time.monotonic()
+        with self._lock:
+            pool = self._pools.get(key, ())
+            while pool:
+                conn, last_used = pool.pop()
+                if now - last_used < self.idle_timeout and conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                    return conn, True  # an idle socket is readable only if the server closed it
+                conn.close()
+        scheme, host, port = key
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(host, port, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, collections.deque())
+            if len(pool) < self.max_per_host:
+                pool.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def request(self, method: str, url: str, body=None, headers=None, max_redirects=5) -> HttpResponse:
+        """Send a request and read the whole response.
+
+        Redirects are followed like urlopen() does: all of them for GET/HEAD, and 301/302/303 for other methods, turned into a GET without body.
+
+        Args:
+            method: str. 'GET', 'POST', ...
+            url: str.
+            body: bytes. Default is None.
+            headers: dict. Default is None.
+            max_redirects: int. Redirects followed before HTTPError is raised. Default is 5.
+        Returns:
+            HttpResponse: (status, headers, body). body is decompressed if it was gzipped.
+        """
+        import urllib.parse
+        import urllib.error
+        headers = dict(headers or {})
+        if self.gzip:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        for hop in range(max_redirects + 1):
+            rsp = self._send(method, url, body, headers)
+            location = rsp.headers.get('Location')
+            is_get = method.upper() in ('GET', 'HEAD')
+            if not location or rsp.status not in ((301, 302, 303, 307, 308) if is_get else (301, 302, 303)):
+                return rsp
+            url = urllib.parse.urljoin(url, location)
+            if not is_get:
+                method, body = 'GET', None
+                headers = {k: v for k, v in headers.items() if k.lower() not in ('content-type', 'content-length')}
+        raise urllib.error.HTTPError(url, rsp.status, "Too many redirects", rsp.headers, io.BytesIO(rsp.body))
+
+    def _send(self, method: str, url: str, body, headers: dict) -> HttpResponse:
+        import urllib.parse
+        import http.client
+        import gzip
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        for attempt in range(2):
+            conn, reused = self._acquire(key)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                sent = True
+                rsp = conn.getresponse()
+                data = rsp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused and attempt == 0 and (not sent or method.upper() in self.IDEMPOTENT_METHODS):
+                    continue  # the server closed the idle connection, retry with a new one. Others may have been processed already.
+                raise
+            if rsp.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            if data and rsp.getheader('Content-Encoding', '').lower() == 'gzip':
+                data = gzip.decompress(data)
+            return HttpResponse(rsp.status, rsp.headers, data)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn, last_used in pool:
+                conn.close()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter.
+
+    Args:
+        rate: float. Tokens added per second.
+        burst: int. Max tokens kept, the size of a burst. Default is 1.
+    """
+    def __init__(self, rate: float, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+CmdResult = collections.namedtuple('CmdResult', ['cmd', 'returncode', 'stdout', 'stderr', 'duration'])  # returned by runCmds()
+
+
+class ResponseCache(LRUCache):
+    """Cache ajax() results, following the HTTP caching headers of responses.
+
+    Entries are keyed on method, url and params, fresh for Cache-Control max-age or until Expires, and revalidated with ETag/Last-Modified when stale. The decoded dict is kept, so a hit never parses JSON again. Only GET responses are cached.
+
+    Args:
+        path: str. JSON file to keep the cache in. Default is None, memory only.
+        maxsize: int. Max number of responses. Default is 256.
+    """
+    def __init__(self, path=None, maxsize=256):
+        super().__init__(maxsize=maxsize, path=path)
+        self.stale = 0
+
+    @staticmethod
+    def key(method: str, url: str) -> str:
+        return method.upper() + " " + url
+
+    def lookup(self, key: str) -> (dict, bool):
+        """Returns (entry or None, is_fresh). Counts hits, stale entries and misses."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._data.move_to_end(key)
+            if entry['expires'] > time.time():
+                self.hits += 1
+                return entry, True
+            self.stale += 1
+            return entry, False
+
+    def store(self, key: str, headers, data, entry=None):
+        """Cache data as the headers allow. Pass the old entry to refresh it after a 304 response."""
+        import email.utils
+        cache_control = {}
+        for directive in (headers.get('Cache-Control') or '').lower().split(','):
+            name, _, value = directive.strip().partition('=')
+            cache_control[name] = value.strip('"')
+        if 'no-store' in cache_control:
+            self.pop(key)
+            return
+        expires = 0
+        if 'no-cache' in cache_control:
+            expires = 0
+        elif cache_control.get('max-age', '').isdigit():
+            expires = time.time() + int(cache_control['max-age']) - int(headers.get('Age') or 0)
+        elif headers.get('Expires'):
+            try:
+                expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                expires = 0  # invalid Expires means already expired
+        etag = headers.get('ETag') or (entry or {}).get('etag')
+        last_modified = headers.get('Last-Modified') or (entry or {}).get('last_modified')
+        if expires > time.time() or etag or last_modified:
+            self.put(key, {'expires': expires, 'etag': etag, 'last_modified': last_modified, 'data': data})
+        else:
+            self.pop(key)
+
+    def stats(self) -> dict:
+        """Returns: dict: size, hits, stale, misses and evictions"""
+        return dict(super().stats(), stale=self.stale)
+
+
+class OutputPolicy(object):
+    """Where the messages of KyanToolKit go: the console, nowhere, a `logging.Logger` or a callback.
+
+    Muted levels are decided once here and have no emitter, so their messages are never formatted. A logger's level is also checked here, set the policy again after changing it.
+
+    Args:
+        target: 'console', 'silent' (or None), a logging.Logger, or callable(level, message). Default is 'console'.
+        level: str. Lowest level to output, one of LEVELS. Default is 'command', everything.
+    """
+    LEVELS = ('command', 'info', 'warn', 'err')
+
+    def __init__(self, target='console', level='command'):
+        if level not in self.LEVELS:
+            raise ValueError("invalid level '{}' ({})".format(level, '/'.join(self.LEVELS)))
+        lowest = self.LEVELS.index(level)
+        self.target = target
+        self.emitters = {name: self._emitter(target, name) if i >= lowest else None for i, name in enumerate(self.LEVELS)}
+
+    @staticmethod
+    def _emitter(target, level: str):
+        if target is None or target == 'silent':
+            return None
+        if target == 'console':
+            def emit(message):
+                import consoleiotools as cit
+                if level == 'command':
+                    cit.echo(message, "command")
+                else:
+                    getattr(cit, level)(message)
+            return emit
+        if hasattr(target, 'isEnabledFor') and hasattr(target, 'log'):  # logging.Logger or LoggerAdapter
+            import logging
+            log_level = {'command': logging.DEBUG, 'info': logging.INFO, 'warn': logging.WARNING, 'err': logging.ERROR}[level]
+            return functools.partial(target.log, log_level) if target.isEnabledFor(log_level) else None
+        if callable(target):
+            return functools.partial(target, level)
+        raise ValueError("invalid output target '{}' (console/silent/logger/callable)".format(target))
+
+    def say(self, level: str, message: str, *args, **kwargs):
+        """Output `message.format(*args, **kwargs)` at `level`, formatting only if the level is enabled"""
+        emit = self.emitters[level]
+        if emit is not None:
+            emit(message.format(*args, **kwargs) if args or kwargs else message)
 
 
 class KyanToolKit(object):
     __version__ = '6.3.4'
+    _cmd_index = CmdIndex()
+    _output = OutputPolicy()  # see setOutput()
+    http_session = None  # HttpSession used by ajax() by default
 
-    def __init__(self, trace_file="trace.xml"):
+    def __init__(self, trace_file="trace.xml", buffered=False, queue_size=10000, on_full='block', trace_format='xml', max_bytes=0, backup_count=5, profile=False, sample_rate=1.0):
+        """
+        Args:
+            trace_file: str. Where TRACE() writes to. Default is "trace.xml".
+            buffered: bool. Set to `True` to write traces in batches from a background thread. Default is False.
+            queue_size: int. Max traces waiting in memory when buffered. Default is 10000.
+            on_full: str. 'block' or 'drop' when the buffer is full. See `TraceWriter`.
+            trace_format: str. 'xml' or 'jsonl'. JSONL traces are one JSON object per line and can be queried with `TraceReader`. Default is 'xml'.
+            max_bytes: int. Rotate the trace file beyond this size. Default is 0, never rotate.
+            backup_count: int. Number of rotated trace files kept. Default is 5.
+            profile: bool. Set to `True` to make inTrace() time calls into `profileReport()` instead of writing traces. Default is False.
+            sample_rate: float. Fraction of calls timed in profile mode, between 0 and 1. Default is 1.0, every call.
+        """
+        if trace_format not in ('xml', 'jsonl'):
+            raise ValueError("invalid trace_format '{}' (xml/jsonl)".format(trace_format))
         self.trace_file = trace_file
+        self.trace_format = trace_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.trace_encoding = 'utf-8' if trace_format == 'jsonl' else None  # TraceReader decodes records as UTF-8
+        self.trace_writer = TraceWriter(trace_file, queue_size=queue_size, on_full=on_full, max_bytes=max_bytes, backup_count=backup_count, encoding=self.trace_encoding) if buffered else None
+        self.profile = profile
+        self.sample_rate = sample_rate
+        self._profile_stats = {}
+        self._profile_lock = threading.Lock()
 
     def __del__(self):
-        pass
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Flush buffered traces and stop the writer thread. Later traces are written directly."""
+        if getattr(self, 'trace_writer', None):
+            self.trace_writer.close()
 
 # -Decorators-----------------------------------------------------
     def inTrace(self, func: callable):  # decorator
-        """将被修饰函数的进入和退出写入日志"""
+        """将被修饰函数的进入和退出写入日志，profile 模式下只统计耗时"""
+        name = func.__qualname__
+
         @wraps(func)
         def call(*args, **kwargs):
-            self.TRACE("Enter " + func.__qualname__ + "()")
+            if self.profile:
+                if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                    return func(*args, **kwargs)
+                wall_start, cpu_start = time.perf_counter(), time.thread_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._profileRecord(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+            self.TRACE("Enter " + name + "()")
             result = func(*args, **kwargs)
-            self.TRACE("Leave " + func.__qualname__ + "()")
+            self.TRACE("Leave " + name + "()")
             return result
         return call
 
+    def _profileRecord(self, name: str, wall: float, cpu: float):
+        bucket = max(0, int(math.log2(wall * 1e6))) if wall > 1e-6 else 0  # 2^n microseconds
+        with self._profile_lock:
+            stat = self._profile_stats.get(name)
+            if stat is None:
+                stat = self._profile_stats[name] = {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'min': wall, 'max': wall, 'histogram': {}}
+            stat['count'] += 1
+            stat['wall'] += wall
+            stat['cpu'] += cpu
+            stat['min'] = min(stat['min'], wall)
+            stat['max'] = max(stat['max'], wall)
+            stat['histogram'][bucket] = stat['histogram'].get(bucket, 0) + 1
+
+    def profileReport(self, reset=False) -> dict:
+        """Get call timings collected by inTrace() in profile mode.
+
+        Args:
+            reset: bool. Set to `True` to clear the statistics after reporting. Default is False.
+
+        Returns:
+            dict: {qualname: {'count', 'wall', 'cpu', 'min', 'max', 'avg', 'histogram'}}. Times are in seconds, 'wall' and 'cpu' are totals of sampled calls. 'histogram' maps n to the count of calls taking [2^n, 2^(n+1)) microseconds.
+        """
+        with self._profile_lock:
+            report = {}
+            for name, stat in self._profile_stats.items():
+                report[name] = dict(stat, histogram=dict(stat['histogram']), avg=stat['wall'] / stat['count'])
+            if reset:
+                self._profile_stats = {}
+        return report
+
+    def profileReset(self):
+        """Clear the statistics collected in profile mode"""
+        with self._profile_lock:
+            self._profile_stats = {}
+
 # -Text Process---------------------------------------------------
     @staticmethod
     def banner(content_="Well Come"):
@@ -56,45 +815,185 @@ class KyanToolKit(object):
 
     @staticmethod
     def md5(words=""):
+        import hashlib
         if type(words) != bytes:  # md5的输入必须为 bytes 类型
             words = str(words).encode()
         return hashlib.md5(words).hexdigest()
 
+    @staticmethod
+    def hashFile(file_, algorithm='md5', chunk_size=1024 * 1024, use_mmap=False, cache=None) -> str:
+        """Hash a file chunk by chunk, so the file never has to fit in memory.
+
+        Args:
+            file_: str/file. Path of the file, or a file object opened in binary mode.
+            algorithm: str. Any algorithm `hashlib.new()` accepts, like 'md5', 'sha256', 'blake2b'. Default is 'md5'.
+            chunk_size: int. Bytes read per chunk. Default is 1MB.
+            use_mmap: bool. Set to `True` to hash a memory-mapped file in one call instead of reading chunks. Default is False.
+            cache: HashCache. Reuse digests of files which are not changed since last hashed. Default is None.
+
+        Returns:
+            str: The hex digest.
+        """
+        import hashlib
+        if cache is not None and not hasattr(file_, 'read'):
+            return cache.hashFile(file_, algorithm, chunk_size=chunk_size, use_mmap=use_mmap)
+        hasher = hashlib.new(algorithm)
+        if hasattr(file_, 'read'):
+            for chunk in iter(lambda: file_.read(chunk_size), b''):
+                hasher.update(chunk)
+            return hasher.hexdigest()
+        with open(file_, 'rb') as f:
+            if use_mmap:
+                if os.fstat(f.fileno()).st_size:  # empty files can not be mapped
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        hasher.update(mm)
+                return hasher.hexdigest()
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                hasher.update(view[:size])
+        return hasher.hexdigest()
+
+    @staticmethod
+    def hashFiles(files, algorithm='md5', max_workers=None, **kwargs) -> dict:
+        """Hash many files concurrently. hashlib releases the GIL, so threads scale with cores and disks.
+
+        Args:
+            files: list. Paths of the files.
+            algorithm: str. See hashFile(). Default is 'md5'.
+            max_workers: int. Max threads. Default is decided by `ThreadPoolExecutor`.
+            **kwargs: Passed to hashFile().
+
+        Returns:
+            dict: {path: hex digest}, in the same order as `files`.
+        """
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = executor.map(lambda f: KyanToolKit.hashFile(f, algorithm, **kwargs), files)
+            return dict(zip(files, digests))
+
 # -Image Process--------------------------------------------------
     @staticmethod
-    def imageToColor(url: str, scale=200, mode='rgb'):
-        """将 url 指向的图片提纯为一个颜色"""
-        from PIL import Image
-        import colorsys
+    def imageToColor(url: str, scale=200, mode='rgb', cache=None, revalidate=False):
+        """将 url 指向的图片提纯为一个颜色
+
+        Args:
+            cache: ImageColorCache. Reuse results of the same url or the same image content. Default is None.
+            revalidate: bool. Download the image again and only reuse the result if the content is unchanged. Default is False.
+        """
+        import urllib.request
+        import hashlib
         if url:
+            if cache is not None and not revalidate:
+                entry = cache.get(cache.urlKey(url, scale, mode))
+                if entry:
+                    return tuple(entry[1]) if isinstance(entry[1], list) else entry[1]
             response = urllib.request.urlopen(url)
-            img_buffer = io.BytesIO(response.read())
-            img = Image.open(img_buffer)
-            img = img.convert('RGBA')
-            img.thumbnail((scale, scale))
-            statistics = {'r': 0, 'g': 0, 'b': 0, 'coef': 0}
-            for cnt, (r, g, b, a) in img.getcolors(img.size[0] * img.size[1]):
-                hsv = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
-                saturation = hsv[1] * 255
-                coefficient = (saturation * cnt * a) + 0.01  # avoid 0
-                statistics['r'] += coefficient * r
-                statistics['g'] += coefficient * g
-                statistics['b'] += coefficient * b
-                statistics['coef'] += coefficient
-                color = (
-                    int(statistics['r'] / statistics['coef']),
-                    int(statistics['g'] / statistics['coef']),
-                    int(statistics['b'] / statistics['coef'])
-                )
-            if mode.lower() == 'rgb':
-                return color
-            elif mode.lower() == 'hex':
-                return "#%0.2X%0.2X%0.2X" % color
-            else:
-                return color
+            img_bytes = response.read()
+            if cache is not None:
+                digest = hashlib.md5(img_bytes).hexdigest()
+                color = cache.get(cache.contentKey(digest, scale, mode))
+                if color is None:
+                    color = KyanToolKit._bytesToColor(img_bytes, scale, mode)
+                    cache.put(cache.contentKey(digest, scale, mode), color)
+                cache.put(cache.urlKey(url, scale, mode), [digest, color])
+                return tuple(color) if isinstance(color, list) else color  # tuples come back as lists from json
+            return KyanToolKit._bytesToColor(img_bytes, scale, mode)
         else:
             return False
 
+    @staticmethod
+    def _bytesToColor(img_bytes: bytes, scale=200, mode='rgb'):
+        from PIL import Image
+        img = Image.open(io.BytesIO(img_bytes))
+        return KyanToolKit._formatColor(KyanToolKit._themeColor(img, scale), mode)
+
+    @staticmethod
+    def imagesToColors(sources, scale=200, mode='rgb', max_workers=None, draft=True, chunksize=16) -> list:
+        """Get theme colors of many local images in parallel processes.
+
+        Args:
+            sources: list. Image file paths, bytes, or file objects opened in binary mode.
+            scale: int. See imageToColor(). Default is 200.
+            mode: str. 'rgb' or 'hex'. Default is 'rgb'.
+            max_workers: int. Max processes. Default is the number of CPUs.
+            draft: bool. Decode JPEGs at reduced size, just big enough for the thumbnail. Default is True.
+            chunksize: int. Images sent to a process at a time. Default is 16.
+
+        Returns:
+            list: Colors in the order of `sources`. If an image fails, its exception is returned in place of the color.
+        """
+        import concurrent.futures
+        jobs = []
+        for source in sources:
+            try:
+                jobs.append(source.read() if hasattr(source, 'read') else source)  # file objects can not be pickled
+            except Exception as e:
+                jobs.append(e)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            worker = functools.partial(KyanToolKit._imageSourceToColor, scale=scale, mode=mode, draft=draft)
+            return list(executor.map(worker, jobs, chunksize=chunksize))
+
+    @staticmethod
+    def _imageSourceToColor(source, scale=200, mode='rgb', draft=True):
+        """imageToColor() for a path or bytes. Returns the exception instead of raising it."""
+        from PIL import Image
+        if isinstance(source, Exception):
+            return source
+        try:
+            img = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+            with img:
+                if draft:
+                    img.draft('RGB', (scale, scale))  # only JPEG supports draft mode, no-op for others
+                return KyanToolKit._formatColor(KyanToolKit._themeColor(img, scale), mode)
+        except Exception as e:
+            return e
+
+    @staticmethod
+    def _themeColor(img, scale=200, use_numpy=True) -> tuple:
+        """Saturation weighted average color of a PIL image. Uses NumPy if available."""
+        img = img.convert('RGBA')
+        img.thumbnail((scale, scale))
+        if use_numpy:
+            try:
+                import numpy
+            except ImportError:
+                use_numpy = False
+        if use_numpy:
+            pixels = numpy.asarray(img, dtype=numpy.uint32).reshape(-1, 4)
+            packed = (pixels[:, 0] << 24) | (pixels[:, 1] << 16) | (pixels[:, 2] << 8) | pixels[:, 3]
+            colors, counts = numpy.unique(packed, return_counts=True)  # same as img.getcolors()
+            r, g, b, a = ((colors >> shift) & 0xFF for shift in (24, 16, 8, 0))
+            rgb = numpy.stack((r, g, b)).astype(numpy.float64)
+            maxc, minc = rgb.max(axis=0), rgb.min(axis=0)
+            saturation = numpy.divide(maxc - minc, maxc, out=numpy.zeros_like(maxc), where=maxc > 0) * 255
+            coefficient = (saturation * counts * a) + 0.01  # avoid 0
+            return tuple(int(c) for c in (rgb * coefficient).sum(axis=1) / coefficient.sum())
+        import colorsys
+        statistics = {'r': 0, 'g': 0, 'b': 0, 'coef': 0}
+        for cnt, (r, g, b, a) in img.getcolors(img.size[0] * img.size[1]):
+            hsv = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+            saturation = hsv[1] * 255
+            coefficient = (saturation * cnt * a) + 0.01  # avoid 0
+            statistics['r'] += coefficient * r
+            statistics['g'] += coefficient * g
+            statistics['b'] += coefficient * b
+            statistics['coef'] += coefficient
+        return (
+            int(statistics['r'] / statistics['coef']),
+            int(statistics['g'] / statistics['coef']),
+            int(statistics['b'] / statistics['coef'])
+        )
+
+    @staticmethod
+    def _formatColor(color: tuple, mode='rgb'):
+        if mode.lower() == 'hex':
+            return "#%0.2X%0.2X%0.2X" % color
+        return color
+
 # -System Fucntions-----------------------------------------------
     @staticmethod
     def clearScreen():
@@ -106,7 +1005,7 @@ class KyanToolKit(object):
         elif 'darwin' in sys.platform:
             os.system('clear')
         else:
-            cit.err("No clearScreen for " + sys.platform)
+            KyanToolKit._output.say('err', "No clearScreen for {}", sys.platform)
 
     @staticmethod
     def getPyCmd():
@@ -118,7 +1017,7 @@ class KyanToolKit(object):
         elif 'darwin' in sys.platform:
             return 'python3'
         else:
-            cit.err("No python3 command for " + sys.platform)
+            KyanToolKit._output.say('err', "No python3 command for {}", sys.platform)
 
     @staticmethod
     def runCmd(cmd):
@@ -130,10 +1029,46 @@ class KyanToolKit(object):
             bool: Does this command run successfully
         """
         SUCCESS_CODE = 0
-        cit.echo(cmd, "command")
+        KyanToolKit._output.say('command', cmd)
         result = os.system(cmd)
         if not result == SUCCESS_CODE:
-            cit.warn("Command Failed")
+            KyanToolKit._output.say('warn', "Command Failed")
+        return result == SUCCESS_CODE
+
+    @staticmethod
+    def runCmds(cmds, max_workers=4, fail_fast=False, echo=False) -> list:
+        """run commands concurrently and collect their results
+
+        Args:
+            cmds: list of string
+            max_workers: int. Max commands running at the same time. Default is 4.
+            fail_fast: bool. Set to `True` to skip commands not started yet once a command fails. Default is False, run all.
+            echo: bool. Show each command on console when it starts. Default is False.
+        Returns:
+            list: CmdResult(cmd, returncode, stdout, stderr, duration) in the order of `cmds`. Skipped commands have `returncode` None.
+        """
+        import subprocess
+        import concurrent.futures
+        SUCCESS_CODE = 0
+        failed = threading.Event()
+
+        def run(cmd):
+            if fail_fast and failed.is_set():
+                return CmdResult(cmd, None, '', '', 0.0)
+            if echo:
+                KyanToolKit._output.say('command', cmd)
+            start = time.perf_counter()
+            try:
+                proc = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                returncode, stdout, stderr = proc.returncode, proc.stdout.decode(errors='replace'), proc.stderr.decode(errors='replace')
+            except OSError as e:  # command not found, etc.
+                returncode, stdout, stderr = 127, '', str(e)
+            if returncode != SUCCESS_CODE:
+                failed.set()
+            return CmdResult(cmd, returncode, stdout, stderr, time.perf_counter() - start)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, cmds))
 
     @staticmethod
     def readCmd(cmd):
@@ -144,12 +1079,177 @@ class KyanToolKit(object):
         Returns:
             str: what the command's echo
         """
-        cit.echo(cmd, "command")
+        import subprocess
+        KyanToolKit._output.say('command', cmd)
         args = shlex.split(cmd)
         proc = subprocess.Popen(args, stdout=subprocess.PIPE)
         (proc_stdout, proc_stderr) = proc.communicate(input=None)  # proc_stdin
         return proc_stdout.decode()  # stdout & stderr is in bytes format
 
+    @staticmethod
+    def iterCmd(cmd, timeout=None, chunk_size=0, encoding='utf-8', stderr=None):
+        """run command and yield its stdout while it is running, in constant memory
+
+        Args:
+            cmd: string
+            timeout: float. Seconds before the command is killed and `subprocess.TimeoutExpired` is raised. Default is None, no timeout.
+            chunk_size: int. Yield decoded chunks of up to `chunk_size` bytes instead of lines. Default is 0, yield lines.
+            encoding: str. Encoding of the output, decoded incrementally. Default is 'utf-8'.
+            stderr: callable. Called with each decoded stderr line, from a separate thread. Default is None, stderr is not captured.
+        Yields:
+            str: lines (or chunks) of the command's stdout
+        """
+        import subprocess
+        KyanToolKit._output.say('command', cmd)
+        args = shlex.split(cmd)
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE if stderr else None)
+        timed_out = threading.Event()
+        timer = None
+        if timeout is not None:
+            def kill():
+                timed_out.set()
+                proc.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        stderr_thread = None
+        if stderr:
+            def drain():
+                decoder = codecs.getincrementaldecoder(encoding)('replace')
+                for line in proc.stderr:
+                    stderr(decoder.decode(line))
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    stderr(tail)
+            stderr_thread = threading.Thread(target=drain, daemon=True)
+            stderr_thread.start()
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            read = (lambda: proc.stdout.read1(chunk_size)) if chunk_size else proc.stdout.readline
+            for data in iter(read, b''):
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            proc.wait()
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(args, timeout)
+        finally:
+            if timer:
+                timer.cancel()
+            if proc.poll() is None:  # stopped early by caller
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            if stderr_thread:
+                stderr_thread.join()
+                proc.stderr.close()
+
+    @staticmethod
+    async def readCmdAsync(cmd, semaphore=None):
+        """asyncio version of readCmd(). The command is killed if the task is cancelled.
+
+        Args:
+            cmd: string
+            semaphore: asyncio.Semaphore. Acquired while the command runs, to cap concurrency. Default is None.
+        Returns:
+            str: what the command's echo
+        """
+        KyanToolKit._output.say('command', cmd)
+        result = await KyanToolKit._runCmdAsync(cmd, semaphore, capture_stderr=False)
+        return result.stdout
+
+    @staticmethod
+    async def runCmdsAsync(cmds, max_concurrency=16, echo=False) -> list:
+        """asyncio version of runCmds(), runs all commands with at most `max_concurrency` at the same time
+
+        Args:
+            cmds: list of string
+            max_concurrency: int. Default is 16.
+            echo: bool. Show each command on console when it starts. Default is False.
+        Returns:
+            list: CmdResult in the order of `cmds`
+        """
+        import asyncio
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(cmd):
+            try:
+                return await KyanToolKit._runCmdAsync(cmd, semaphore, echo=echo)
+            except OSError as e:  # command not found, etc.
+                return CmdResult(cmd, 127, '', str(e), 0.0)
+        return list(await asyncio.gather(*(run(cmd) for cmd in cmds)))
+
+    @staticmethod
+    async def iterCmdAsync(cmd, semaphore=None, encoding='utf-8'):
+        """asyncio version of iterCmd(), yields stdout lines while the command runs
+
+        Args:
+            cmd: string
+            semaphore: asyncio.Semaphore. Acquired while the command runs. Default is None.
+            encoding: str. Default is 'utf-8'.
+        Yields:
+            str: lines of the command's stdout
+        """
+        import asyncio
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            proc = await asyncio.create_subprocess_exec(*shlex.split(cmd), stdout=asyncio.subprocess.PIPE)
+            try:
+                decoder = codecs.getincrementaldecoder(encoding)()
+                pending = ''
+                while True:
+                    data = await proc.stdout.read(65536)
+                    lines = (pending + decoder.decode(data, final=not data)).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        yield line + '\n'
+                    if not data:
+                        if pending:
+                            yield pending
+                        break
+                await proc.wait()
+            finally:
+                if proc.returncode is None:  # cancelled or closed early
+                    proc.kill()
+                    await proc.wait()
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    @staticmethod
+    async def isCmdExistAsync(cmd):
+        """asyncio version of isCmdExist(), run in the default executor"""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, KyanToolKit.isCmdExist, cmd)
+
+    @staticmethod
+    async def _runCmdAsync(cmd, semaphore=None, echo=False, capture_stderr=True) -> CmdResult:
+        import asyncio
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            if echo:
+                KyanToolKit._output.say('command', cmd)
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *shlex.split(cmd), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE if capture_stderr else None
+            )
+            try:
+                stdout, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+            return CmdResult(cmd, proc.returncode, stdout.decode(errors='replace'), (stderr or b'').decode(errors='replace'), time.perf_counter() - start)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
     @staticmethod
     def isCmdExist(cmd):
         """test if command is available for execution
@@ -159,14 +1259,18 @@ class KyanToolKit(object):
         Returns:
             bool: if the command is exist
         """
-        if sys.platform.startswith('win'):
-            result = os.system("where {} >nul 2>&1".format(cmd))
-            return (result == 0)
-        else:
-            proc = os.popen("command -v {}".format(cmd))
-            result = proc.read()
-            proc.close()
-            return (result != "")
+        return KyanToolKit._cmd_index.has(cmd)
+
+    @staticmethod
+    def areCmdsExist(cmds) -> dict:
+        """test many commands at once, checking PATH for changes only once
+
+        Args:
+            cmds: list of string
+        Returns:
+            dict: {cmd: bool}
+        """
+        return KyanToolKit._cmd_index.hasAll(cmds)
 
     @staticmethod
     def getDir(file_) -> (str, str):
@@ -186,7 +1290,7 @@ class KyanToolKit(object):
         return dirname, basename
 
     @staticmethod
-    def diff(a, b, force_str=False, context=0) -> list:
+    def diff(a, b, force_str=False, context=0, engine='difflib') -> list:
         """Compare two strings/lists or files and return their diffs.
 
         Args:
@@ -194,75 +1298,722 @@ class KyanToolKit(object):
             b: str/list/file. The target of comparison.
             force_str: bool. Set to `True` if you wanna force to compare `a` and `b` as string. Default is False.
             context: int. Number of context lines returns with diffs. Default is 0, no context lines shows.
+            engine: str. 'difflib' or 'patience'. 'patience' interns lines to ints, skips the common head and tail, reads files through mmap and aligns on unique lines, so it stays fast on large inputs with many repeated lines. Default is 'difflib'.
 
         Returns:
             list: Diffs where the dst is not same as src. Only lines with diffs in the result. The first 2 lines are the header of diffs.
         """
+        import difflib
+        if engine not in ('difflib', 'patience'):
+            raise ValueError("invalid engine '{}' (difflib/patience)".format(engine))
         src, dst = {'raw': a}, {'raw': b}
         for d in (src, dst):
             if isinstance(d['raw'], str):
                 if (not force_str) and os.path.isfile(d['raw']):
                     d['label'] = os.path.basename(d['raw'])  # filename will show in header of diffs
-                    with open(d['raw'], encoding='utf-8') as f:
-                        d['content'] = f.readlines()
+                    if engine == 'patience':
+                        d['content'] = KyanToolKit._mmapLines(d['raw'])
+                    else:
+                        with open(d['raw'], encoding='utf-8') as f:
+                            d['content'] = f.readlines()
                 else:
                     d['label'] = str(str)
                     d['content'] = d['raw'].split('\n')  # convert str to list for comparison. Ex. ['str',]
             else:
                 d['label'] = str(type(d['raw']))
                 d['content'] = d['raw']
-        diffs = difflib.unified_diff(src['content'], dst['content'], n=context, fromfile=src['label'], tofile=dst['label'])
-        return [ln.strip('\n') for ln in diffs]  # Ensure no \n returns
+        if engine == 'difflib':
+            diffs = difflib.unified_diff(src['content'], dst['content'], n=context, fromfile=src['label'], tofile=dst['label'])
+            return [ln.strip('\n') for ln in diffs]  # Ensure no \n returns
+        decode = None
+        if all(isinstance(d['content'], KyanToolKit._ByteLines) for d in (src, dst)):
+            decode = bytes.decode  # file vs file: compare bytes, only decode lines in diffs
+        else:
+            for d in (src, dst):
+                if isinstance(d['content'], KyanToolKit._ByteLines):
+                    d['content'] = [ln.decode('utf-8') for ln in d['content']]
+        blocks = KyanToolKit._patienceBlocks(src['content'], dst['content'])
+        diffs = KyanToolKit._unifiedDiff(src['content'], dst['content'], blocks, context, src['label'], dst['label'], decode)
+        return [ln.strip('\n') for ln in diffs]
+
+    @staticmethod
+    def diffDirs(dir1, dir2, context=0, engine='patience', max_workers=None, trust_mtime=True, max_pending=64):
+        """Compare two directory trees, yielding results while walking them.
+
+        Files only in one tree are reported right away. Files with different sizes are changed; files with the same size are compared chunk by chunk, unless `trust_mtime` and their mtimes are equal. Only changed files are line-diffed, in parallel processes.
+
+        Args:
+            dir1: str. The source directory.
+            dir2: str. The target directory.
+            context: int. See diff(). Default is 0.
+            engine: str. See diff(). Default is 'patience'.
+            max_workers: int. Max processes. Default is the number of CPUs.
+            trust_mtime: bool. Treat files with the same size and mtime as unchanged without reading them. Default is True.
+            max_pending: int. Max files being compared at the same time, bounds memory. Default is 64.
+
+        Yields:
+            (str, str, list): (status, relative path, diffs). status is 'added', 'removed' or 'changed'. diffs is the diff() of a changed file, or None if the file is added, removed or not utf-8 text.
+        """
+        import concurrent.futures
+        pending = collections.deque()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for status, relpath in KyanToolKit._walkDirPair(dir1, dir2, '', trust_mtime):
+                if status == 'maybe':
+                    future = executor.submit(KyanToolKit._diffFilePair, os.path.join(dir1, relpath), os.path.join(dir2, relpath), context, engine)
+                    pending.append((relpath, future))
+                else:
+                    pending.append((relpath, status))
+                while len(pending) > max_pending:
+                    result = KyanToolKit._diffDirsResult(*pending.popleft())
+                    if result:
+                        yield result
+            while pending:
+                result = KyanToolKit._diffDirsResult(*pending.popleft())
+                if result:
+                    yield result
+
+    @staticmethod
+    def _diffDirsResult(relpath, status_or_future):
+        if isinstance(status_or_future, str):
+            return (status_or_future, relpath, None)
+        changed, diffs = status_or_future.result()
+        return ('changed', relpath, diffs) if changed else None
 
     @staticmethod
-    def updateFile(file_, url):
+    def _walkDirPair(dir1: str, dir2: str, relpath: str, trust_mtime: bool):
+        """Yield (status, relpath) of files under dir1/relpath and dir2/relpath. status 'maybe' means same size, content not compared yet."""
+        def scan(dirpath):
+            try:
+                with os.scandir(dirpath) as entries:
+                    return {entry.name: entry for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                return {}
+
+        def walk_one(status, root, rel):
+            entry_path = os.path.join(root, rel)
+            if os.path.isdir(entry_path):
+                for name in sorted(os.listdir(entry_path)):
+                    yield from walk_one(status, root, os.path.join(rel, name))
+            else:
+                yield (status, rel)
+
+        entries1 = scan(os.path.join(dir1, relpath))
+        entries2 = scan(os.path.join(dir2, relpath))
+        for name in sorted(set(entries1) | set(entries2)):
+            rel = os.path.join(relpath, name)
+            e1, e2 = entries1.get(name), entries2.get(name)
+            is_dir1 = e1 is not None and e1.is_dir()
+            is_dir2 = e2 is not None and e2.is_dir()
+            if e1 is not None and e2 is not None and is_dir1 and is_dir2:
+                yield from KyanToolKit._walkDirPair(dir1, dir2, rel, trust_mtime)
+            elif e1 is not None and e2 is not None and not is_dir1 and not is_dir2:
+                st1, st2 = e1.stat(), e2.stat()
+                if st1.st_size != st2.st_size:
+                    yield ('maybe', rel)  # surely changed, diff() confirms it
+                elif not (trust_mtime and st1.st_mtime_ns == st2.st_mtime_ns):
+                    yield ('maybe', rel)
+            else:
+                if e1 is not None:
+                    yield from walk_one('removed', dir1, rel)
+                if e2 is not None:
+                    yield from walk_one('added', dir2, rel)
+
+    @staticmethod
+    def _diffFilePair(file1: str, file2: str, context=0, engine='patience') -> (bool, list):
+        if not KyanToolKit._filesDiffer(file1, file2):
+            return False, None
+        try:
+            return True, KyanToolKit.diff(file1, file2, context=context, engine=engine)
+        except UnicodeDecodeError:
+            return True, None
+
+    @staticmethod
+    def hasDiff(a, b, force_str=False) -> bool:
+        """Cheap check of whether diff() would find any difference. Files are compared chunk by chunk and stop at the first difference.
+
+        Args:
+            a: str/list/file. See diff().
+            b: str/list/file. See diff().
+            force_str: bool. See diff().
+
+        Returns:
+            bool: `True` if `a` and `b` are different. Files are compared byte by byte, so a '\r\n' vs '\n' change counts as different.
+        """
+        is_file = [isinstance(x, str) and not force_str and os.path.isfile(x) for x in (a, b)]
+        if all(is_file):
+            return KyanToolKit._filesDiffer(a, b)
+        if any(is_file):
+            return bool(KyanToolKit.diff(a, b, force_str, engine='patience'))
+        if isinstance(a, str) and isinstance(b, str):
+            return a != b
+        a, b = (x.split('\n') if isinstance(x, str) else list(x) for x in (a, b))  # str compares by lines, as in diff()
+        return a != b
+
+    @staticmethod
+    def _filesDiffer(file1: str, file2: str, chunk_size=1024 * 1024) -> bool:
+        if os.path.getsize(file1) != os.path.getsize(file2):
+            return True
+        with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+            while True:
+                chunk1, chunk2 = f1.read(chunk_size), f2.read(chunk_size)
+                if chunk1 != chunk2:
+                    return True
+                if not chunk1:
+                    return False
+
+    class _ByteLines(list):
+        """Lines of a file as bytes, with '\r\n' turned into '\n' as text mode does"""
+
+    @staticmethod
+    def _mmapLines(filepath: str) -> list:
+        lines = KyanToolKit._ByteLines()
+        with open(filepath, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return lines
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    lines.append(line[:-2] + b'\n' if line.endswith(b'\r\n') else line)
+        return lines
+
+    @staticmethod
+    def _patienceBlocks(a: list, b: list) -> list:
+        """Matching blocks [(i, j, size), ...] of a and b, as `SequenceMatcher.get_matching_blocks()` without the sentinel"""
+        import difflib
+        table = {}
+        ids_a = [table.setdefault(ln, len(table)) for ln in a]
+        ids_b = [table.setdefault(ln, len(table)) for ln in b]
+        blocks = []
+        regions = [(0, len(ids_a), 0, len(ids_b))]
+        while regions:
+            alo, ahi, blo, bhi = regions.pop()
+            # common head and tail
+            head = 0
+            while alo + head < ahi and blo + head < bhi and ids_a[alo + head] == ids_b[blo + head]:
+                head += 1
+            if head:
+                blocks.append((alo, blo, head))
+                alo, blo = alo + head, blo + head
+            tail = 0
+            while alo < ahi - tail and blo < bhi - tail and ids_a[ahi - tail - 1] == ids_b[bhi - tail - 1]:
+                tail += 1
+            if tail:
+                blocks.append((ahi - tail, bhi - tail, tail))
+                ahi, bhi = ahi - tail, bhi - tail
+            if alo == ahi or blo == bhi:
+                continue
+            # anchor on lines unique in both sides, longest increasing run of them by patience sorting
+            count_a = collections.Counter(ids_a[alo:ahi])
+            count_b = collections.Counter(ids_b[blo:bhi])
+            index_a = {ids_a[i]: i for i in range(alo, ahi) if count_a[ids_a[i]] == 1 and count_b.get(ids_a[i]) == 1}
+            pairs = sorted((index_a[ids_b[j]], j) for j in range(blo, bhi) if ids_b[j] in index_a)
+            if not pairs:
+                matcher = difflib.SequenceMatcher(None, ids_a[alo:ahi], ids_b[blo:bhi])
+                blocks.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+                continue
+            tops, backlinks = [], []
+            for k, (i, j) in enumerate(pairs):
+                pos = bisect.bisect_left(tops, (j,))
+                backlinks.append(tops[pos - 1][1] if pos else None)
+                if pos == len(tops):
+                    tops.append((j, k))
+                else:
+                    tops[pos] = (j, k)
+            anchors = []
+            k = tops[-1][1]
+            while k is not None:
+                anchors.append(pairs[k])
+                k = backlinks[k]
+            anchors.reverse()
+            prev_i, prev_j = alo, blo
+            for i, j in anchors:
+                blocks.append((i, j, 1))
+                regions.append((prev_i, i, prev_j, j))
+                prev_i, prev_j = i + 1, j + 1
+            regions.append((prev_i, ahi, prev_j, bhi))
+        merged = []
+        for i, j, size in sorted(blocks):
+            if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+                merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+            else:
+                merged.append((i, j, size))
+        return merged
+
+    @staticmethod
+    def _unifiedDiff(a: list, b: list, blocks: list, n: int, fromfile: str, tofile: str, decode=None):
+        """Same output as `difflib.unified_diff()`, from precomputed matching blocks"""
+        def format_range(start, stop):
+            beginning, length = start + 1, stop - start
+            if length == 1:
+                return '{}'.format(beginning)
+            if not length:
+                beginning -= 1
+            return '{},{}'.format(beginning, length)
+
+        def text(lines):
+            return (decode(ln) for ln in lines) if decode else lines
+
+        codes, i, j = [], 0, 0
+        for ai, bj, size in blocks + [(len(a), len(b), 0)]:
+            tag = 'replace' if i < ai and j < bj else 'delete' if i < ai else 'insert' if j < bj else ''
+            if tag:
+                codes.append((tag, i, ai, j, bj))
+            i, j = ai + size, bj + size
+            if size:
+                codes.append(('equal', ai, i, bj, j))
+        if not codes:
+            codes = [('equal', 0, 1, 0, 1)]
+        # group codes as SequenceMatcher.get_grouped_opcodes()
+        if codes[0][0] == 'equal':
+            tag, i1, i2, j1, j2 = codes[0]
+            codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+        if codes[-1][0] == 'equal':
+            tag, i1, i2, j1, j2 = codes[-1]
+            codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+        groups, group = [], []
+        for tag, i1, i2, j1, j2 in codes:
+            if tag == 'equal' and i2 - i1 > n + n:
+                group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+                groups.append(group)
+                group = []
+                i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+            group.append((tag, i1, i2, j1, j2))
+        if group and not (len(group) == 1 and group[0][0] == 'equal'):
+            groups.append(group)
+        for k, group in enumerate(groups):
+            if k == 0:
+                yield '--- {}'.format(fromfile)
+                yield '+++ {}'.format(tofile)
+            yield '@@ -{} +{} @@'.format(format_range(group[0][1], group[-1][2]), format_range(group[0][3], group[-1][4]))
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    for line in text(a[i1:i2]):
+                        yield ' ' + line
+                    continue
+                if tag in ('replace', 'delete'):
+                    for line in text(a[i1:i2]):
+                        yield '-' + line
+                if tag in ('replace', 'insert'):
+                    for line in text(b[j1:j2]):
+                        yield '+' + line
+
+    @staticmethod
+    def updateFile(file_, url, interactive=True, conditional=False, delta=False):
         """Check and update file compares with remote_url
 
+        The remote file is streamed into a temp file while hashed, and only moved over `file_` (atomically) when it differs.
+
         Args:
             file_: str. Local filename. Normally it's __file__
             url: str. Remote url of raw file content. Normally it's https://raw.github.com/...
+            interactive: bool. Ask before updating. Set to `False` to update without asking. Default is True.
+            conditional: bool. Keep the ETag/Last-Modified of `url` in `file_.http.json` and send them next time, so an unchanged remote file costs one 304 response. Default is False.
+            delta: bool. Fetch the block signature at `url + '.blocks'` (see makeBlockSignature()) and download only the blocks missing locally, with HTTP Range requests. Falls back to a full download if there is no signature. Default is False.
         Returns:
             bool: file updated or not
         """
-        def compare(s1, s2):
-            return s1 == s2, len(s2) - len(s1)
-
+        import urllib.request
+        import urllib.error
+        import shutil
+        import consoleiotools as cit
         if not url or not file_:
             return False
+        validators_file = file_ + ".http.json"
+        tmp = None
         try:
-            req = urllib.request.urlopen(url)
-            raw_codes = req.read()
-            with open(file_, 'rb') as f:
-                current_codes = f.read().replace(b'\r', b'')
-            is_same, diff = compare(current_codes, raw_codes)
-            if is_same:
-                cit.info("{} is already up-to-date.".format(file_))
+            signature = KyanToolKit._fetchSignature(url + ".blocks") if delta else None
+            remote_headers = None
+            if signature:
+                current_md5, current_size = KyanToolKit.hashFile(file_), os.path.getsize(file_)
+                if current_md5 == signature['hash']:
+                    KyanToolKit._output.say('info', "{} is already up-to-date.", file_)
+                    return False
+                tmp, raw_md5, raw_size = KyanToolKit._deltaDownload(file_, url, signature)
+            else:
+                headers = {}
+                if conditional:
+                    validators = KyanToolKit._loadValidators(validators_file, file_)
+                    if validators.get('etag'):
+                        headers['If-None-Match'] = validators['etag']
+                    if validators.get('last_modified'):
+                        headers['If-Modified-Since'] = validators['last_modified']
+                try:
+                    req = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+                except urllib.error.HTTPError as e:
+                    if e.code == 304:  # Not Modified
+                        KyanToolKit._output.say('info', "{} is already up-to-date.", file_)
+                        return False
+                    raise
+                with req:
+                    tmp, raw_md5, raw_size = KyanToolKit._downloadTemp(req, file_)
+                    remote_headers = req.headers
+                current_md5, current_size = KyanToolKit._hashText(file_)
+            diff = raw_size - current_size
+            if current_md5 == raw_md5:
+                KyanToolKit._output.say('info', "{} is already up-to-date.", file_)
+                if conditional and remote_headers:
+                    KyanToolKit._saveValidators(validators_file, file_, remote_headers)
                 return False
             else:
-                cit.ask("A new version is available. Update? (Diff: {})".format(diff))
-                if cit.get_choice(['Yes', 'No']) == 'Yes':
-                    with open(file_, 'wb') as f:
-                        f.write(raw_codes)
-                    cit.info("Update Success.")
+                if interactive:
+                    cit.ask("A new version is available. Update? (Diff: {})".format(diff))
+                if not interactive or cit.get_choice(['Yes', 'No']) == 'Yes':
+                    shutil.copymode(file_, tmp)
+                    os.replace(tmp, file_)
+                    tmp = None
+                    if conditional and remote_headers:
+                        KyanToolKit._saveValidators(validators_file, file_, remote_headers)
+                    KyanToolKit._output.say('info', "Update Success.")
                     return True
                 else:
-                    cit.warn("Update Canceled")
+                    KyanToolKit._output.say('warn', "Update Canceled")
                     return False
         except Exception as e:
-            cit.err("{f} update failed: {e}".format(f=file_, e=e))
+            KyanToolKit._output.say('err', "{f} update failed: {e}", f=file_, e=e)
             return False
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def makeBlockSignature(file_, block_size=64 * 1024, output=None) -> dict:
+        """Make the block signature for delta updates of file_, to publish beside it as `file_.blocks`
+
+        Args:
+            file_: str. The file to publish.
+            block_size: int. Default is 64KB.
+            output: str. Where to write the signature as JSON. Default is None, `file_ + '.blocks'`. Set to '' to not write.
+        Returns:
+            dict: {'block_size', 'size', 'hash': md5 of the file, 'blocks': [[weak checksum, md5], ...]}
+        """
+        import hashlib
+        import json
+        blocks = []
+        hasher = hashlib.md5()
+        with open(file_, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+                blocks.append([KyanToolKit._weakChecksum(block), hashlib.md5(block).hexdigest()])
+        signature = {'block_size': block_size, 'size': os.path.getsize(file_), 'hash': hasher.hexdigest(), 'blocks': blocks}
+        output = file_ + ".blocks" if output is None else output
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(signature, f)
+        return signature
+
+    @staticmethod
+    def _weakChecksum(block: bytes) -> int:
+        """rsync rolling checksum: a = sum of bytes, b = sum of prefix sums, both mod 2^16"""
+        a = sum(block) & 0xFFFF
+        b = sum(itertools.accumulate(block)) & 0xFFFF
+        return a | (b << 16)
+
+    @staticmethod
+    def _fetchSignature(url: str):
+        import urllib.request
+        import json
+        try:
+            with urllib.request.urlopen(url) as rsp:
+                return json.loads(rsp.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _deltaDownload(file_: str, url: str, signature: dict, give_up=2, max_skip=16) -> (str, str, int):
+        """Rebuild the remote file in a temp file from local blocks plus Range requests. Returns (temp path, md5, size).
+
+        The rolling checksum moves one byte at a time in Python. After `give_up` blocks worth of bytes without a match, the scan jumps ahead (by 1, 2, 4 ... up to `max_skip` blocks) and probes one block worth of bytes at a time. A probe landing in shifted or unchanged data finds a match, then the blocks before it are checked with md5 at the same shift, so skipped matches are recovered. Set `give_up` to None to scan every byte.
+        """
+        import urllib.request
+        import hashlib
+        import tempfile
+        block_size, size = signature['block_size'], signature['size']
+        blocks = signature['blocks']
+        weak_index = {}
+        for i, (weak, strong) in enumerate(blocks):
+            if (i + 1) * block_size <= size:  # full blocks are searched with the rolling checksum
+                weak_index.setdefault(weak, []).append(i)
+        found = {}  # block index: local offset
+        with open(file_, 'rb') as f:
+            local_size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if local_size else b''
+            try:
+                last = len(blocks) - 1
+                if blocks and last not in found and len(blocks) * block_size > size:  # the short last block, try same offset and the end
+                    length = size - last * block_size
+                    for offset in (last * block_size, local_size - length):
+                        if 0 <= offset and offset + length <= local_size and hashlib.md5(data[offset:offset + length]).hexdigest() == blocks[last][1]:
+                            found[last] = offset
+                            break
+                pos = probe_start = 0
+                probe_size = give_up * block_size if give_up else None
+                skip = block_size
+                weak = KyanToolKit._weakChecksum(data[0:block_size]) if local_size >= block_size else None
+                while weak is not None and len(found) < len(blocks):
+                    a, b = weak & 0xFFFF, weak >> 16
+                    if weak in weak_index:
+                        strong = hashlib.md5(data[pos:pos + block_size]).hexdigest()
+                        matched = [i for i in weak_index[weak] if blocks[i][1] == strong]
+                        if matched:
+                            for i in matched:
+                                found.setdefault(i, pos)
+                                j, offset = i - 1, pos - block_size
+                                while j >= 0 and offset >= 0 and j not in found and hashlib.md5(data[offset:offset + block_size]).hexdigest() == blocks[j][1]:
+                                    found[j] = offset  # skipped by a jump, same shift
+                                    j, offset = j - 1, offset - block_size
+                            pos += block_size
+                            probe_start, probe_size, skip = pos, give_up * block_size if give_up else None, block_size
+                            weak = KyanToolKit._weakChecksum(data[pos:pos + block_size]) if pos + block_size <= local_size else None
+                            continue
+                    if pos + block_size >= local_size:
+                        break
+                    if probe_size and pos - probe_start >= probe_size:  # nothing here, jump ahead and probe again
+                        pos += skip
+                        probe_start, probe_size, skip = pos, block_size, min(skip * 2, max_skip * block_size)
+                        weak = KyanToolKit._weakChecksum(data[pos:pos + block_size]) if pos + block_size <= local_size else None
+                        continue
+                    out, new = data[pos], data[pos + block_size]
+                    a = (a - out + new) & 0xFFFF
+                    b = (b - block_size * out + a) & 0xFFFF
+                    weak = a | (b << 16)
+                    pos += 1
+                for i in range(len(blocks)):  # blocks changed in place, inside a skipped range
+                    offset = i * block_size
+                    if i not in found and offset + block_size <= min(size, local_size) and hashlib.md5(data[offset:offset + block_size]).hexdigest() == blocks[i][1]:
+                        found[i] = offset
+                hasher = hashlib.md5()
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_)), prefix='.ktk-')
+                try:
+                    with os.fdopen(fd, 'wb') as out_file:
+                        i = 0
+                        while i < len(blocks):
+                            if i in found:
+                                length = min(block_size, size - i * block_size)
+                                chunk = data[found[i]:found[i] + length]
+                                i += 1
+                            else:
+                                end = i
+                                while end < len(blocks) and end not in found:
+                                    end += 1
+                                start_byte, end_byte = i * block_size, min(end * block_size, size) - 1
+                                req = urllib.request.Request(url, headers={'Range': 'bytes={}-{}'.format(start_byte, end_byte)})
+                                with urllib.request.urlopen(req) as rsp:
+                                    chunk = rsp.read()
+                                    if rsp.status != 206:  # Range not supported, got the whole file
+                                        chunk = chunk[start_byte:end_byte + 1]
+                                i = end
+                            hasher.update(chunk)
+                            out_file.write(chunk)
+                    if hasher.hexdigest() != signature['hash']:
+                        raise ValueError("delta update verification failed")
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+            finally:
+                if local_size:
+                    data.close()
+        return tmp, hasher.hexdigest(), size
+
+    @staticmethod
+    def updateFiles(manifest_url, root, max_workers=8, retries=2, atomic=False, cache=None) -> dict:
+        """Sync many files with a remote manifest, downloading only files whose hashes differ
+
+        The manifest is a JSON like `{"algorithm": "md5", "files": {"path/to/file": {"hash": "...", "size": 123}}}` (or `{"path/to/file": "hash"}` as "files"). Files are downloaded from their paths relative to `manifest_url`, verified, then moved into place.
+
+        Args:
+            manifest_url: str. Url of the manifest.
+            root: str. Local directory the manifest paths are relative to.
+            max_workers: int. Max concurrent checks and downloads. Default is 8.
+            retries: int. Retries of a failed download, with exponential backoff. Default is 2.
+            atomic: bool. Set to `True` to update nothing unless every download succeeds. Default is False.
+            cache: HashCache. Reuse digests of local files which are not changed. Default is None.
+        Returns:
+            dict: {'updated': [paths], 'unchanged': [paths], 'failed': {path: error}, 'skipped': [paths downloaded but not applied, since atomic update failed]}
+        """
+        import urllib.request
+        import urllib.parse
+        import json
+        import concurrent.futures
+        import shutil
+        with urllib.request.urlopen(manifest_url) as rsp:
+            manifest = json.loads(rsp.read().decode('utf-8'))
+        algorithm = manifest.get('algorithm', 'md5')
+        entries = {path: (info if isinstance(info, dict) else {'hash': info}) for path, info in manifest['files'].items()}
+        root = os.path.abspath(root)
+        summary = {'updated': [], 'unchanged': [], 'failed': {}, 'skipped': []}
+        created_dirs = []
+
+        def prepare(tmp, local):  # directories are created only now, so a rejected batch leaves nothing behind
+            missing = []
+            parent = os.path.dirname(local)
+            while not os.path.isdir(parent):
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            created_dirs.extend(missing)
+            if os.path.exists(local):
+                shutil.copymode(local, tmp)  # temp files already have the mode of a new file
+
+        def install(tmp, local):
+            prepare(tmp, local)
+            os.replace(tmp, local)
+
+        def sync(path, info):
+            local = os.path.abspath(os.path.join(root, *path.split('/')))
+            if os.path.commonpath([root, local]) != root:
+                raise ValueError("path outside of root")
+            if os.path.isfile(local):
+                if info.get('size') in (None, os.path.getsize(local)) and KyanToolKit.hashFile(local, algorithm, cache=cache) == info['hash']:
+                    return local, None
+            tmp_dir = os.path.dirname(local)
+            while not os.path.isdir(tmp_dir):  # download next to the deepest existing directory
+                tmp_dir = os.path.dirname(tmp_dir)
+            url = urllib.parse.urljoin(manifest_url, urllib.parse.quote(path))
+            for attempt in range(retries + 1):
+                try:
+                    with urllib.request.urlopen(url) as rsp:
+                        tmp, digest, size = KyanToolKit._downloadTemp(rsp, local, algorithm, dir_=tmp_dir)
+                    if digest == info['hash']:
+                        break
+                    os.remove(tmp)
+                    error = ValueError("hash mismatch")
+                except OSError as e:
+                    error = e
+                if attempt < retries:
+                    time.sleep(0.5 * 2 ** attempt)
+            else:
+                raise error
+            if not atomic:
+                try:
+                    install(tmp, local)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+            return local, tmp
+
+        downloaded = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {path: executor.submit(sync, path, info) for path, info in entries.items()}
+            for path, future in futures.items():
+                try:
+                    local, tmp = future.result()
+                except Exception as e:
+                    summary['failed'][path] = str(e)
+                    continue
+                if tmp is None:
+                    summary['unchanged'].append(path)
+                else:
+                    downloaded[path] = (local, tmp)
+        try:
+            if atomic and not summary['failed']:
+                for path, (local, tmp) in downloaded.items():  # check every file can be moved into place before moving any
+                    try:
+                        prepare(tmp, local)
+                    except OSError as e:
+                        summary['failed'][path] = str(e)
+                if summary['failed']:
+                    for d in sorted(created_dirs, reverse=True):  # deepest first
+                        try:
+                            os.rmdir(d)
+                        except OSError:
+                            pass
+            if atomic and summary['failed']:
+                summary['skipped'].extend(path for path in downloaded if path not in summary['failed'])
+            else:
+                for path, (local, tmp) in downloaded.items():
+                    if atomic:
+                        try:
+                            os.replace(tmp, local)
+                        except OSError as e:
+                            summary['failed'][path] = str(e)
+                            continue
+                    summary['updated'].append(path)
+        finally:
+            for local, tmp in downloaded.values():
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        KyanToolKit._output.say('info', "Updated: {}, Unchanged: {}, Failed: {}", len(summary['updated']), len(summary['unchanged']), len(summary['failed']))
+        return summary
+
+    @staticmethod
+    def _downloadTemp(response, file_: str, algorithm='md5', chunk_size=64 * 1024, dir_=None) -> (str, str, int):
+        """Stream a response into a temp file next to file_, or in dir_. Returns (temp path, hex digest, size).
+
+        The temp file is created with mode 0666 & ~umask, like a new file, instead of the 0600 of mkstemp().
+        """
+        import hashlib
+        hasher = hashlib.new(algorithm)
+        size = 0
+        while True:
+            tmp = os.path.join(dir_ or os.path.dirname(os.path.abspath(file_)), '.ktk-' + os.urandom(6).hex())
+            try:
+                fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666)
+                break
+            except FileExistsError:
+                continue
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: response.read(chunk_size), b''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, hasher.hexdigest(), size
+
+    @staticmethod
+    def _hashText(file_: str, chunk_size=64 * 1024) -> (str, int):
+        """md5 and size of a file with '\r' removed, as it was fetched from a raw url"""
+        import hashlib
+        hasher = hashlib.md5()
+        size = 0
+        with open(file_, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                chunk = chunk.replace(b'\r', b'')
+                hasher.update(chunk)
+                size += len(chunk)
+        return hasher.hexdigest(), size
+
+    @staticmethod
+    def _loadValidators(validators_file: str, file_: str) -> dict:
+        """Saved ETag/Last-Modified, only if file_ is not modified locally since they were saved"""
+        import json
+        try:
+            with open(validators_file, encoding='utf-8') as f:
+                validators = json.load(f)
+            st = os.stat(file_)
+        except (OSError, ValueError):
+            return {}
+        if validators.get('local') != [st.st_size, st.st_mtime_ns]:
+            return {}
+        return validators
+
+    @staticmethod
+    def _saveValidators(validators_file: str, file_: str, headers):
+        import json
+        st = os.stat(file_)
+        validators = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'), 'local': [st.st_size, st.st_mtime_ns]}
+        with open(validators_file, 'w', encoding='utf-8') as f:
+            json.dump(validators, f)
 
 # -Get Information------------------------------------------------
     @staticmethod
-    def ajax(url, param={}, method='get'):
+    def ajax(url, param=None, method='get', session=None, cache=None):
         """Get info by ajax
 
         Args:
             url: string
+            param: dict. Default is None.
+            method: str. 'get' or 'post'. Default is 'get'.
+            session: HttpSession. Reuse pooled keep-alive connections. Default is `KyanToolKit.http_session`, which is None unless set.
+            cache: ResponseCache. Reuse results of GET requests as Cache-Control/Expires allow, revalidating with ETag/Last-Modified. Default is None.
         Returns:
-            dict: json decoded into a dict
+            dict: json decoded into a dict. Results from cache are the same object, do not modify them.
         """
-        param = urllib.parse.urlencode(param)
+        import urllib.request
+        import urllib.parse
+        import json
+        param = urllib.parse.urlencode(param or {})
         if method.lower() == 'get':
             req = urllib.request.Request(url + '?' + param)
         elif method.lower() == 'post':
@@ -270,58 +2021,356 @@ class KyanToolKit(object):
             req = urllib.request.Request(url, data=param)
         else:
             raise Exception("invalid method '{}' (GET/POST)".format(method))
-        rsp = urllib.request.urlopen(req)
+        session = session or KyanToolKit.http_session
+        if cache is None or req.get_method() != 'GET':
+            status, headers, body = KyanToolKit._ajaxFetch(req, session)
+            return json.loads(body.decode('utf-8')) if body is not None else None
+        key = cache.key(req.get_method(), req.full_url)
+        entry, is_fresh = cache.lookup(key)
+        if is_fresh:
+            return entry['data']
+        if entry:
+            if entry.get('etag'):
+                req.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                req.add_header('If-Modified-Since', entry['last_modified'])
+        status, headers, body = KyanToolKit._ajaxFetch(req, session)
+        if status == 304 and entry:
+            cache.store(key, headers, entry['data'], entry)
+            return entry['data']
+        if body is None:
+            return None
+        rsp_dict = json.loads(body.decode('utf-8'))
+        cache.store(key, headers, rsp_dict)
+        return rsp_dict
+
+    @staticmethod
+    def ajaxStream(url, param=None, method='get', format_='auto', chunk_size=64 * 1024):
+        """Yield records of a large JSON response while it is downloading, holding at most one record in memory
+
+        Args:
+            url: string
+            param: dict. Default is None.
+            method: str. 'get' or 'post'. Default is 'get'.
+            format_: str. 'ndjson' for one JSON per line, 'array' for a top-level JSON array, or 'auto' to decide by Content-Type and the first character. Default is 'auto'.
+            chunk_size: int. Bytes read from the network at a time. Default is 64KB.
+        Yields:
+            Records decoded from each line, or each item of the array.
+        """
+        import urllib.request
+        import urllib.parse
+        if format_ not in ('auto', 'ndjson', 'array'):
+            raise ValueError("invalid format_ '{}' (auto/ndjson/array)".format(format_))
+        param = urllib.parse.urlencode(param or {})
+        if method.lower() == 'get':
+            req = urllib.request.Request(url + '?' + param)
+        elif method.lower() == 'post':
+            req = urllib.request.Request(url, data=param.encode('utf-8'))
+        else:
+            raise Exception("invalid method '{}' (GET/POST)".format(method))
+        with urllib.request.urlopen(req) as rsp:
+            if format_ == 'auto' and any(t in (rsp.headers.get('Content-Type') or '') for t in ('ndjson', 'jsonl', 'json-seq')):
+                format_ = 'ndjson'
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            chunks = (decoder.decode(chunk) for chunk in iter(lambda: rsp.read(chunk_size), b''))
+            yield from KyanToolKit._iterJson(chunks, format_)
+
+    @staticmethod
+    def _iterJson(chunks, format_='auto'):
+        """Decode records from str chunks of NDJSON or a JSON array"""
+        import json
+        json_decoder = json.JSONDecoder()
+        buffer = ''
+        pos = 0
+        started = format_ == 'ndjson'
+        eof = False
+        chunks = iter(chunks)
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n' + (',' if started and format_ == 'array' else ''):
+                pos += 1
+            if pos >= len(buffer):
+                if eof:
+                    break
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                    continue
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            if not started:
+                if format_ == 'auto':
+                    format_ = 'array' if buffer[pos] == '[' else 'ndjson'
+                if format_ == 'array':
+                    if buffer[pos] != '[':
+                        raise ValueError("response is not a JSON array")
+                    pos += 1
+                started = True
+                continue
+            if format_ == 'array' and buffer[pos] == ']':
+                break
+            try:
+                record, end = json_decoder.raw_decode(buffer, pos)
+            except ValueError:
+                record, end = None, None  # incomplete, read more
+            if end is not None and (end < len(buffer) or eof):
+                yield record
+                pos = end
+                continue
+            if eof:
+                raise ValueError("truncated JSON at: {!r}".format(buffer[pos:pos + 50]))
+            buffer = buffer[pos:]
+            pos, size, more = 0, len(buffer), []
+            while size < 2 * len(buffer):  # decode again once the buffer doubled, a large record is not re-parsed per chunk
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                    break
+                more.append(chunk)
+                size += len(chunk)
+            buffer += ''.join(more)
+
+    @staticmethod
+    def ajaxBatch(specs, max_workers=8, per_host=4, rate=None, retries=3, backoff=0.5, session=None, cache=None, retry_post=False) -> list:
+        """Run many ajax() requests concurrently
+
+        Args:
+            specs: list. Each is a url, or a tuple of (url, param, method).
+            max_workers: int. Max requests in flight. Default is 8.
+            per_host: int. Max requests in flight to the same host. Default is 4.
+            rate: float/TokenBucket. Max requests started per second, or a TokenBucket shared with other batches. Default is None, unlimited.
+            retries: int. Retries of transient errors (connection errors, timeouts, 408/429/5xx) of GET requests, with exponential backoff. Default is 3.
+            backoff: float. Seconds before the first retry, doubled each time. Default is 0.5.
+            session: HttpSession. See ajax().
+            cache: ResponseCache. See ajax().
+            retry_post: bool. Retry POST requests too. A POST the server already processed may be applied twice. Default is False.
+        Returns:
+            list: Results in the order of `specs`. A failed request gives its exception in place of the dict.
+        """
+        results = [None] * len(specs)
+        for index, result in KyanToolKit.ajaxBatchIter(specs, max_workers, per_host, rate, retries, backoff, session, cache, retry_post):
+            results[index] = result
+        return results
+
+    @staticmethod
+    def ajaxBatchIter(specs, max_workers=8, per_host=4, rate=None, retries=3, backoff=0.5, session=None, cache=None, retry_post=False):
+        """Same as ajaxBatch(), but yields (index, result) as soon as each request completes"""
+        import urllib.parse
+        import concurrent.futures
+        specs = [(spec, None, 'get') if isinstance(spec, str) else tuple(spec) + (None, 'get')[len(spec) - 1:] for spec in specs]
+        bucket = rate if isinstance(rate, TokenBucket) else TokenBucket(rate) if rate else None
+        host_limits = collections.defaultdict(lambda: threading.Semaphore(per_host))
+        host_limits_lock = threading.Lock()
+
+        def call(url, param, method):
+            with host_limits_lock:
+                host_limit = host_limits[urllib.parse.urlsplit(url).netloc]
+            attempts = retries + 1 if retry_post or method.lower() == 'get' else 1
+            for attempt in range(attempts):
+                if bucket:
+                    bucket.acquire()
+                try:
+                    with host_limit:
+                        return KyanToolKit.ajax(url, param, method, session=session, cache=cache)
+                except Exception as e:
+                    if attempt == attempts - 1 or not KyanToolKit._isTransientError(e):
+                        return e
+                time.sleep(backoff * 2 ** attempt * random.uniform(1, 1.25))  # with jitter
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(call, *spec): index for index, spec in enumerate(specs)}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+    @staticmethod
+    def _isTransientError(e: Exception) -> bool:
+        import urllib.error
+        import http.client
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code in (408, 429, 500, 502, 503, 504)
+        return isinstance(e, (urllib.error.URLError, ConnectionError, TimeoutError, http.client.HTTPException))
+
+    @staticmethod
+    def _ajaxFetch(req, session=None) -> (int, object, bytes):
+        """Send a urllib Request through session or urlopen. Returns (status, headers, body). 304 is returned, other non-2xx statuses raise HTTPError."""
+        import urllib.request
+        import urllib.error
+        import http.client
+        if session is not None:
+            headers = dict(req.header_items())
+            if req.data:
+                headers.setdefault('Content-type', 'application/x-www-form-urlencoded')
+            rsp = session.request(req.get_method(), req.full_url, body=req.data, headers=headers)
+            if rsp.status != 304 and not 200 <= rsp.status < 300:
+                raise urllib.error.HTTPError(req.full_url, rsp.status, http.client.responses.get(rsp.status, ''), rsp.headers, io.BytesIO(rsp.body))
+            return rsp.status, rsp.headers, rsp.body
+        try:
+            rsp = urllib.request.urlopen(req)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:  # Not Modified
+                return e.code, e.headers, b''
+            raise
         if rsp:
-            rsp_json = rsp.read().decode('utf-8')
-            rsp_dict = json.loads(rsp_json)
-            return rsp_dict
-        return None
+            with rsp:
+                return rsp.status, rsp.headers, rsp.read()
+        return None, None, None
+
+    @staticmethod
+    def readFile(filepath, encoding=None, with_encoding=False):
+        """Try different encoding to open a file in readonly mode
+
+        The file is read once. Encodings are picked by BOM, or tried on the first bytes before decoding the whole file.
+
+        Args:
+            filepath: str.
+            encoding: str. Skip detection and use this encoding. Raises UnicodeDecodeError if it does not fit. Default is None.
+            with_encoding: bool. Set to `True` to return (content, encoding), the encoding actually used. Default is False.
+        Returns:
+            str: content of the file, or None if no encoding fits.
+        """
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        output = KyanToolKit._output
+        for mode in ([encoding] if encoding else KyanToolKit._encodingCandidates(data)):
+            try:
+                content = data.decode(mode)
+            except UnicodeDecodeError:
+                output.say('warn', '打开文件：尝试 {} 格式失败', mode)
+                if encoding:
+                    raise
+                continue
+            output.say('info', '以 {} 格式打开文件', mode)
+            if '\r' in content:  # newlines as text mode reads
+                content = content.replace('\r\n', '\n').replace('\r', '\n')
+            return (content, mode) if with_encoding else content
+        return (None, None) if with_encoding else None
+
+    @staticmethod
+    def detectEncoding(filepath, prefix_size=64 * 1024) -> str:
+        """Guess the encoding of a file by BOM, or by the first encoding that decodes its first bytes
+
+        Only the first `prefix_size` bytes are checked, use readFile(with_encoding=True) for the encoding that decodes the whole file.
+
+        Returns:
+            str: The encoding, or None if nothing fits.
+        """
+        with open(filepath, 'rb') as f:
+            prefix = f.read(prefix_size)
+        candidates = KyanToolKit._encodingCandidates(prefix, prefix_size, warn=False)
+        return candidates[0] if candidates else None
+
+    @staticmethod
+    def readFileLines(filepath, encoding=None):
+        """Yield lines of a file of any size, decoding incrementally
+
+        Args:
+            filepath: str.
+            encoding: str. Default is None, detectEncoding().
+        """
+        encoding = encoding or KyanToolKit.detectEncoding(filepath)
+        with open(filepath, mode='r', encoding=encoding) as f:
+            yield from f
+
+    @staticmethod
+    def readFiles(filepaths, max_workers=None) -> dict:
+        """readFile() many files in parallel threads
+
+        Returns:
+            dict: {filepath: content}, in the order of `filepaths`
+        """
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(filepaths, executor.map(KyanToolKit.readFile, filepaths)))
 
     @staticmethod
-    def readFile(filepath):
-        """Try different encoding to open a file in readonly mode"""
-        for mode in ("utf-8", 'gbk', 'cp1252', 'windows-1252', 'latin-1'):
+    def _encodingCandidates(data: bytes, prefix_size=64 * 1024, warn=True) -> list:
+        """Encodings worth a full decode of data: those which decode the prefix, the BOM one first"""
+        modes = ["utf-8", 'gbk', 'cp1252', 'windows-1252', 'latin-1']
+        for bom, mode in ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+            if data.startswith(bom):
+                modes.insert(0, mode)
+                break
+        candidates = []
+        warn = KyanToolKit._output.emitters['warn'] if warn else None
+        for mode in modes:
             try:
-                with open(filepath, mode='r', encoding=mode) as f:
-                    content = f.read()
-                    cit.info('以 {} 格式打开文件'.format(mode))
-                    return content
+                codecs.getincrementaldecoder(mode)().decode(data[:prefix_size], final=len(data) <= prefix_size)
+                candidates.append(mode)
             except UnicodeDecodeError:
-                cit.warn('打开文件：尝试 {} 格式失败'.format(mode))
-        return None
+                if warn:
+                    warn('打开文件：尝试 {} 格式失败'.format(mode))
+        return candidates
 
 
 # -Pre-checks---------------------------------------------------
     @staticmethod
-    @cit.as_session("Platform Check")
     def needPlatform(expect_platform: str):
-        cit.info("Need: " + expect_platform)
-        cit.info("Current: " + sys.platform)
-        if expect_platform not in sys.platform:
-            cit.bye("Platform Check Failed")
+        import consoleiotools as cit
+
+        @cit.as_session("Platform Check")
+        def check():
+            cit.info("Need: " + expect_platform)
+            cit.info("Current: " + sys.platform)
+            if expect_platform not in sys.platform:
+                cit.bye("Platform Check Failed")
+        check()
 
     @staticmethod
-    @cit.as_session("User Check")
     def needUser(expect_user: str):
-        cit.info("Need: " + expect_user)
-        cit.info("Current: " + KyanToolKit.getUser())
-        if KyanToolKit.getUser() != expect_user:
-            cit.bye("User Check Failed")
+        import consoleiotools as cit
+
+        @cit.as_session("User Check")
+        def check():
+            cit.info("Need: " + expect_user)
+            cit.info("Current: " + KyanToolKit.getUser())
+            if KyanToolKit.getUser() != expect_user:
+                cit.bye("User Check Failed")
+        check()
 
 # -Debug---------------------------------------------------------
+    @staticmethod
+    def setOutput(target='console', level='command'):
+        """Choose where messages like command echoes, readFile() encoding attempts and updateFile() results go
+
+        Args:
+            target: 'console', 'silent' (or None), a logging.Logger, or callable(level, message). Default is 'console', as before.
+            level: str. Lowest level to output: 'command', 'info', 'warn' or 'err'. Default is 'command', everything.
+        Returns:
+            OutputPolicy: the new policy
+        """
+        KyanToolKit._output = OutputPolicy(target, level)
+        return KyanToolKit._output
+
     def TRACE(self, input_: str, trace_type='INFO'):
         trace_content = ''.join(input_)
-        current_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
+        current_timestamp = time.time()
+        current_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(current_timestamp))
         current_function = sys._getframe().f_back
         current_function_name = current_function.f_code.co_name
         current_line = current_function.f_code.co_firstlineno
         current_filename = current_function.f_code.co_filename
-        trace_header = '\n<{type} FILE="{file}" LINE="{line}" TIME="{time}" FUNC="{func}()">\n'.format(
-            type=trace_type, file=current_filename, line=str(current_line),
-            time=current_time, func=current_function_name
-        )
-        with open(self.trace_file, 'a') as trace:
-            trace.write(trace_header + trace_content + "\n</" + trace_type + ">\n")
+        if self.trace_format == 'jsonl':
+            import json
+            trace_record = json.dumps({
+                'type': trace_type, 'file': current_filename, 'line': current_line,
+                'time': current_time, 'ts': current_timestamp, 'func': current_function_name,
+                'content': trace_content
+            }, ensure_ascii=False) + "\n"
+        else:
+            trace_header = '\n<{type} FILE="{file}" LINE="{line}" TIME="{time}" FUNC="{func}()">\n'.format(
+                type=trace_type, file=current_filename, line=str(current_line),
+                time=current_time, func=current_function_name
+            )
+            trace_record = trace_header + trace_content + "\n</" + trace_type + ">\n"
+        if self.trace_writer:
+            self.trace_writer.write(trace_record)
+        else:
+            TraceWriter.append(self.trace_file, trace_record, self.max_bytes, self.backup_count, self.trace_encoding)
+
+    def flush(self):
+        """Write out buffered traces, if any"""
+        if self.trace_writer:
+            self.trace_writer.flush()
 
 
 # -Internal Uses-------------------------------------------------
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import hashlib
+import threading
+import email.utils
+import http.server
+
+
+class FakeServer:
+    '''
+    用于替代网络请求的本地 HTTP 服务
+    提供 root 目录下的文件，支持 ETag / If-Modified-Since / Range
+    routes 中的路径优先，值为 handler -> (status, headers, body)
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.routes = {}
+        self.log = []  # (method, path, status)
+        self.clients = []  # (host, port) of each request
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def do_HEAD(self):
+                fake._handle(self, head=True)
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handle(self, handler, head=False):
+        path = handler.path.split('?')[0].lstrip('/')
+        if path in self.routes:
+            status, headers, body = self.routes[path](handler)
+        else:
+            status, headers, body = self._file(handler, path)
+        self.log.append((handler.command, handler.path, status))
+        self.clients.append(handler.client_address)
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        if isinstance(body, (bytes, bytearray)):
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            if not head:
+                handler.wfile.write(body)
+        else:  # iterable of chunks, length unknown
+            handler.send_header('Connection', 'close')
+            handler.end_headers()
+            handler.close_connection = True
+            for chunk in body:
+                handler.wfile.write(chunk)
+
+    def _file(self, handler, path):
+        filepath = os.path.join(self.root, path)
+        if not os.path.isfile(filepath):
+            return 404, {}, b'Not Found'
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        mtime = int(os.path.getmtime(filepath))
+        headers = {
+            'ETag': '"{}"'.format(hashlib.md5(content).hexdigest()),
+            'Last-Modified': email.utils.formatdate(mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if handler.headers.get('If-None-Match') == headers['ETag']:
+            return 304, headers, b''
+        since = handler.headers.get('If-Modified-Since')
+        if since and 'If-None-Match' not in handler.headers and email.utils.parsedate_to_datetime(since).timestamp() >= mtime:
+            return 304, headers, b''
+        match = re.match(r'bytes=(\d*)-(\d*)$', handler.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1)) if match.group(1) else len(content) - int(match.group(2))
+            end = int(match.group(2)) if match.group(1) and match.group(2) else len(content) - 1
+            end = min(end, len(content) - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(content))
+            return 206, headers, content[start:end + 1]
+        return 200, headers, content
+
+    @staticmethod
+    def readBody(handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        return handler.rfile.read(length) if length else b''
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+##################################################################
+# Benchmarks for KTK, fully offline
+#
+#   python tests/bench_KyanToolKit.py                     # run, compare with bench_baseline.json
+#   python tests/bench_KyanToolKit.py --save              # run, store the results as the new baseline
+#   python tests/bench_KyanToolKit.py -k diff -o out.json # run matching benchmarks, write results
+#
+# Exit code is 1 when a benchmark is slower than its baseline by more than --threshold.
+##################################################################
+import sys
+import os
+import io
+import re
+import json
+import time
+import random
+import shlex
+import timeit
+import argparse
+import platform
+import tempfile
+
+import FakeServer
+
+ktk_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ktk_dir)
+import KyanToolKit  # noqa
+
+ktk = KyanToolKit.KyanToolKit
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def makeText(lines: int, seed=0) -> str:
+    rnd = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'kyan', 'tool', 'kit', '测试', '中文']
+    return ''.join(' '.join(rnd.choice(words) for _ in range(8)) + '\n' for _ in range(lines))
+
+
+def mutateText(text: str, ratio=0.01, seed=1) -> str:
+    rnd = random.Random(seed)
+    lines = text.splitlines(keepends=True)
+    for i in rnd.sample(range(len(lines)), max(1, int(len(lines) * ratio))):
+        lines[i] = 'changed {}\n'.format(i)
+    return ''.join(lines)
+
+
+def makeImage(size: int, seed=0) -> bytes:
+    from PIL import Image
+    rnd = random.Random(seed)
+    img = Image.frombytes('RGB', (size, size), rnd.getrandbits(size * size * 24).to_bytes(size * size * 3, 'little'))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class Fixtures(object):
+    """Files, a local http server and commands the benchmarks run against"""
+    def __init__(self, root: str):
+        self.root = root
+        self.server = FakeServer.FakeServer(root)
+        small, large = makeText(1000), makeText(50000)
+        self.files = {}
+        for name, text, encoding in (
+            ('small.txt', small, 'utf-8'),
+            ('large.txt', large, 'utf-8'),
+            ('small_changed.txt', mutateText(small), 'utf-8'),
+            ('large_changed.txt', mutateText(large), 'utf-8'),
+            ('small_gbk.txt', small, 'gbk'),
+        ):
+            self.files[name] = self.write(name, text.encode(encoding))
+        self.files['blob.bin'] = self.write('blob.bin', random.Random(0).getrandbits(16 * 1024 * 1024 * 8).to_bytes(16 * 1024 * 1024, 'little'))
+        self.texts = {'1KB': small[:1024], '1MB': (large * 2)[:1024 * 1024]}
+        self.server.routes['small.json'] = lambda h: (200, {'Content-Type': 'application/json'}, json.dumps({'ok': True, 'n': 1}).encode())
+        self.server.routes['large.json'] = lambda h: (200, {'Content-Type': 'application/json'}, json.dumps({'items': [{'id': i, 'name': 'item {}'.format(i)} for i in range(20000)]}).encode())
+        self.images = {}
+        try:
+            for size in (64, 1024):
+                self.images[size] = self.write('image_{}.png'.format(size), makeImage(size))
+        except ImportError:  # Pillow not installed, skip imageToColor
+            pass
+        self.cmd = '{} -c pass'.format(shlex.quote(sys.executable))
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def close(self):
+        self.server.close()
+
+
+def benchmarks(fx: Fixtures) -> dict:
+    """name -> callable, one per entry point and input size"""
+    benches = {
+        'md5[1KB]': lambda: ktk.md5(fx.texts['1KB']),
+        'md5[1MB]': lambda: ktk.md5(fx.texts['1MB']),
+        'hashFile[16MB]': lambda: ktk.hashFile(fx.files['blob.bin']),
+        'readFile[small]': lambda: ktk.readFile(fx.files['small.txt']),
+        'readFile[large]': lambda: ktk.readFile(fx.files['large.txt']),
+        'readFile[gbk]': lambda: ktk.readFile(fx.files['small_gbk.txt']),
+        'diff[small]': lambda: ktk.diff(fx.files['small.txt'], fx.files['small_changed.txt']),
+        'diff[large]': lambda: ktk.diff(fx.files['large.txt'], fx.files['large_changed.txt']),
+        'diff[large,patience]': lambda: ktk.diff(fx.files['large.txt'], fx.files['large_changed.txt'], engine='patience'),
+        'ajax[small]': lambda: ktk.ajax(fx.server.url('small.json')),
+        'ajax[large]': lambda: ktk.ajax(fx.server.url('large.json')),
+        'updateFile[unchanged]': lambda: ktk.updateFile(fx.files['large.txt'], fx.server.url('large.txt'), interactive=False),
+        'updateFile[changed]': lambda: (fx.write('target.txt', b'old\n'), ktk.updateFile(fx.files['target.txt'], fx.server.url('small.txt'), interactive=False)),
+        'readCmd': lambda: ktk.readCmd(fx.cmd),
+        'runCmd': lambda: ktk.runCmd(fx.cmd),
+        'isCmdExist': lambda: ktk.isCmdExist('python3'),
+        'isCmdExist[cold]': lambda: (setattr(ktk, '_cmd_index', KyanToolKit.CmdIndex()), ktk.isCmdExist('python3')),
+    }
+    fx.files['target.txt'] = os.path.join(fx.root, 'target.txt')
+    for size in fx.images:
+        benches['imageToColor[{}px]'.format(size)] = (lambda size=size: ktk.imageToColor(fx.server.url('image_{}.png'.format(size))))
+    return benches
+
+
+def measure(func: callable, repeat=5) -> dict:
+    """Time `func` like timeit: calibrate the loop count to ~0.2s, keep the best and the median of `repeat` runs"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    return {'best': times[0], 'median': times[len(times) // 2], 'number': number, 'repeat': repeat}
+
+
+def compare(results: dict, baseline: dict, threshold=0.5, min_delta=0.0005) -> list:
+    """Find regressions of `results` against `baseline`
+
+    Args:
+        threshold: float. Allowed slowdown of the best time, 0.5 means 50%. Default is 0.5.
+        min_delta: float. Slowdowns smaller than this many seconds are noise. Default is 0.0005.
+    Returns:
+        list: (name, baseline seconds, current seconds) of each regressed benchmark.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['best'] > base['best'] * (1 + threshold) and result['best'] - base['best'] > min_delta:
+            regressions.append((name, base['best'], result['best']))
+    return regressions
+
+
+def run(pattern=None, repeat=5) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        fx = Fixtures(root)
+        try:
+            old_stdout, old_fd = sys.stdout, os.dup(1)
+            try:
+                for name, func in benchmarks(fx).items():
+                    if pattern and not re.search(pattern, name):
+                        continue
+                    with open(os.devnull, 'w') as devnull:  # mute console output, os.system() included
+                        sys.stdout = devnull
+                        os.dup2(devnull.fileno(), 1)
+                        try:
+                            results[name] = measure(func, repeat)
+                        finally:
+                            sys.stdout.flush()
+                            os.dup2(old_fd, 1)
+                            sys.stdout = old_stdout
+                    print('{:<24} {:>12.6f}s  (median {:.6f}s, {} loops)'.format(name, results[name]['best'], results[name]['median'], results[name]['number']), flush=True)
+            finally:
+                os.close(old_fd)
+        finally:
+            fx.close()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Offline benchmarks of KyanToolKit')
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks whose name matches this regex')
+    parser.add_argument('-o', '--output', help='write the results as json to this file')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline json to compare with (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed slowdown, 0.5 means 50%% (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark (default: %(default)s)')
+    args = parser.parse_args(argv)
+    report = {
+        'version': ktk.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': run(args.pattern, args.repeat),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save:
+        if os.path.exists(args.baseline):  # keep benchmarks not run this time
+            with open(args.baseline) as f:
+                report['results'] = dict(json.load(f)['results'], **report['results'])
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, run with --save to create one'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('platform') != report['platform'] or baseline.get('python') != report['python']:
+        print('Note: baseline is from {} / Python {}'.format(baseline.get('platform'), baseline.get('python')))
+    regressions = compare(report['results'], baseline['results'], args.threshold)
+    for name, before, after in regressions:
+        print('REGRESSION {}: {:.6f}s -> {:.6f}s (+{:.0%})'.format(name, before, after, after / before - 1))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,12 +5,31 @@
 import sys
 import os
 import unittest
+import contextlib
 import getpass
+import hashlib
+import json
+import io
+import gzip
+import urllib.parse
+import urllib.error
+import http.client
+import pathlib
+import re
+import collections
+import itertools
+import random
+import time
+import tempfile
+import subprocess
+import asyncio
+import logging
 from unittest.mock import patch
 
 import FakeOut
 import FakeIn
 import FakeOs
+import FakeServer
 
 ktk_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, ktk_dir)
@@ -49,6 +68,16 @@ class test_KyanToolKit(unittest.TestCase):
         sys.stdin = self.console_in
         os.system = self.os_system
 
+    @contextlib.contextmanager
+    def fakeServer(self):
+        """A FakeServer serving a temp directory (`server.root`), closed on exit"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server = FakeServer.FakeServer(tmpdir)
+            try:
+                yield server
+            finally:
+                server.close()
+
     def test_version(self):
         self.assertEqual(self.ktk_version, self.ktk.__version__)
 
@@ -72,6 +101,51 @@ class test_KyanToolKit(unittest.TestCase):
         md5 = self.ktk.md5(b'Test Text')
         self.assertEqual(md5, 'f1feeaa3d698685b6a6179520449e206')
 
+    def test_hashFile(self):
+        filepath = os.path.join(ktk_dir, 'tests', 'testfile')
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        self.assertEqual(self.ktk.hashFile(filepath), self.ktk.md5(content))
+        self.assertEqual(self.ktk.hashFile(filepath, chunk_size=3), self.ktk.md5(content))
+        self.assertEqual(self.ktk.hashFile(filepath, 'sha256', use_mmap=True), hashlib.sha256(content).hexdigest())
+        with open(filepath, 'rb') as f:
+            self.assertEqual(self.ktk.hashFile(f, 'blake2b'), hashlib.blake2b(content).hexdigest())
+
+    def test_hashFiles(self):
+        files = [os.path.join(ktk_dir, 'tests', fl) for fl in ('testfile2', 'testfile')]
+        digests = self.ktk.hashFiles(files, 'sha256', max_workers=2)
+        self.assertEqual(list(digests), files)
+        for fl in files:
+            self.assertEqual(digests[fl], self.ktk.hashFile(fl, 'sha256'))
+
+    def test_hashFile_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'file')
+            with open(filepath, 'w') as f:
+                f.write("Test Text")
+            cache = KyanToolKit.HashCache(os.path.join(tmpdir, 'cache.json'))
+            self.assertEqual(self.ktk.hashFile(filepath, cache=cache), 'f1feeaa3d698685b6a6179520449e206')
+            self.assertEqual(self.ktk.hashFile(filepath, cache=cache), 'f1feeaa3d698685b6a6179520449e206')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            with open(filepath, 'w') as f:
+                f.write("Test Text Changed")
+            os.utime(filepath, ns=(0, 0))
+            self.assertEqual(self.ktk.hashFile(filepath, cache=cache), self.ktk.md5("Test Text Changed"))
+            self.assertEqual(cache.misses, 2)
+            cache.save()
+            reloaded = KyanToolKit.HashCache(cache.path)
+            self.assertEqual(self.ktk.hashFiles([filepath], cache=reloaded)[filepath], self.ktk.md5("Test Text Changed"))
+            self.assertEqual(reloaded.hits, 1)
+
+    def test_LRUCache(self):
+        cache = KyanToolKit.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 0, 'evictions': 1})
+
     def test_imageToColor_rgb(self):
         test_url = "http://www.kyan001.com/static/img/index/div_card_products.png"
         color = self.ktk.imageToColor(test_url)
@@ -82,6 +156,54 @@ class test_KyanToolKit(unittest.TestCase):
         color = self.ktk.imageToColor(test_url, mode='hex')
         self.assertEqual(color, '#0593D0')
 
+    def test_themeColor_numpy(self):
+        from PIL import Image
+        img = Image.new('RGBA', (300, 200))
+        img.putdata([((x * 7) % 256, (x * 13) % 256, (x * 31) % 256, (x * 3) % 256) for x in range(300 * 200)])
+        for scale in (50, 200):
+            fast = self.ktk._themeColor(img, scale)
+            slow = self.ktk._themeColor(img, scale, use_numpy=False)
+            for c1, c2 in zip(fast, slow):
+                self.assertTrue(abs(c1 - c2) <= 1)
+        gray = Image.new('RGBA', (10, 10), (128, 128, 128, 255))
+        self.assertEqual(self.ktk._themeColor(gray), (128, 128, 128))
+        self.assertEqual(self.ktk._formatColor((5, 147, 208), 'hex'), '#0593D0')
+
+    def test_imagesToColors(self):
+        from PIL import Image
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jpg = os.path.join(tmpdir, 'blue.jpg')
+            Image.new('RGB', (1000, 800), (5, 147, 208)).save(jpg)
+            png = io.BytesIO()
+            Image.new('RGBA', (50, 50), (200, 10, 10, 255)).save(png, 'PNG')
+            with open(jpg, 'rb') as f, patch("sys.stdin", new=self.console_in):  # child processes close stdin
+                colors = self.ktk.imagesToColors([jpg, png.getvalue(), b'not an image', f], mode='hex', max_workers=2)
+        self.assertEqual(len(colors), 4)
+        self.assertEqual(colors[1], '#C80A0A')
+        self.assertTrue(isinstance(colors[2], Exception))
+        self.assertEqual(colors[0], colors[3])
+        for c1, c2 in zip(bytes.fromhex(colors[0][1:]), (5, 147, 208)):
+            self.assertTrue(abs(c1 - c2) <= 2)  # jpeg is lossy
+
+    def test_imageToColor_cache(self):
+        from PIL import Image
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('a.png', 'b.png'):
+                Image.new('RGBA', (50, 50), (200, 10, 10, 255)).save(os.path.join(tmpdir, name))
+            url_a, url_b = (pathlib.Path(tmpdir, name).as_uri() for name in ('a.png', 'b.png'))
+            cache = KyanToolKit.ImageColorCache(os.path.join(tmpdir, 'cache.json'))
+            self.assertEqual(self.ktk.imageToColor(url_a, cache=cache), (200, 10, 10))
+            with patch("urllib.request.urlopen", side_effect=AssertionError("no network")):
+                self.assertEqual(self.ktk.imageToColor(url_a, cache=cache), (200, 10, 10))
+            with patch.object(self.ktk, "_bytesToColor", side_effect=AssertionError("no decoding")):
+                self.assertEqual(self.ktk.imageToColor(url_b, cache=cache), (200, 10, 10))  # same content
+                self.assertEqual(self.ktk.imageToColor(url_a, cache=cache, revalidate=True), (200, 10, 10))
+            self.assertEqual(self.ktk.imageToColor(url_a, mode='hex', cache=cache), '#C80A0A')
+            cache.save()
+            reloaded = KyanToolKit.ImageColorCache(cache.path)
+            with patch("urllib.request.urlopen", side_effect=AssertionError("no network")):
+                self.assertEqual(self.ktk.imageToColor(url_b, cache=reloaded), (200, 10, 10))
+
     def test_clearScreen(self):
         self.ktk.clearScreen()
         self.assertTrue(self.fakeos.readline() in 'cls clear')
@@ -94,9 +216,82 @@ class test_KyanToolKit(unittest.TestCase):
         self.ktk.runCmd("echo Test Text")
         self.assertEqual(self.fakeos.readline(), "echo Test Text")
 
+    def test_runCmds(self):
+        start = time.perf_counter()
+        results = self.ktk.runCmds(["sleep 0.3", "echo Test Text", "sleep 0.3", "sleep 0.3"], max_workers=4)
+        self.assertTrue(time.perf_counter() - start < sum(r.duration for r in results) * 0.75)  # ran in parallel
+        self.assertEqual([r.returncode for r in results], [0, 0, 0, 0])
+        self.assertEqual(results[1].stdout, "Test Text\n")
+        self.assertTrue(results[0].duration >= 0.3)
+        results = self.ktk.runCmds(["false", "notexist_cmd", "echo Test Text"], max_workers=1, fail_fast=True)
+        self.assertEqual([r.returncode for r in results], [1, None, None])
+
     def test_readCmd(self):
         self.assertEqual(self.ktk.readCmd(r"echo Test Text"), "Test Text\n")
 
+    def test_setOutput(self):
+        self.addCleanup(self.ktk.setOutput)
+        self.ktk.readCmd("echo Test Text")
+        self.assertTrue(self.fakeout.buffer)  # console by default
+        self.fakeout.clean()
+        self.ktk.setOutput('silent')
+        self.ktk.readCmd("echo Test Text")
+        self.ktk.runCmd("notexist_cmd")
+        self.assertEqual(self.fakeout.buffer, "")
+        messages = []
+        self.ktk.setOutput(lambda level, message: messages.append((level, message)), level='warn')
+        self.ktk.runCmd("echo Test Text")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'gbk')
+            with open(filepath, 'wb') as f:
+                f.write('中文'.encode('gbk'))
+            self.ktk.readFile(filepath)
+        self.assertEqual(messages, [('warn', '打开文件：尝试 utf-8 格式失败')])
+        logger = logging.getLogger('ktk_test')
+        logger.setLevel(logging.INFO)
+        policy = self.ktk.setOutput(logger)
+        self.assertIsNone(policy.emitters['command'])  # DEBUG is disabled, never formatted
+        with self.assertLogs(logger, logging.INFO) as logs:
+            self.ktk.readCmd("echo Test Text")
+            self.ktk.setOutput(logger).say('err', "{} failed", "Test")
+        self.assertEqual(logs.output, ['ERROR:ktk_test:Test failed'])
+        with self.assertRaises(ValueError):
+            self.ktk.setOutput(level='debug')
+
+    def test_iterCmd(self):
+        self.assertEqual(list(self.ktk.iterCmd("echo Test Text")), ["Test Text\n"])
+        self.assertEqual("".join(self.ktk.iterCmd("echo Test Text", chunk_size=2)), "Test Text\n")
+        errors = []
+        lines = list(self.ktk.iterCmd("sh -c 'echo out1; echo err >&2; echo out2'", stderr=errors.append))
+        self.assertEqual(lines, ["out1\n", "out2\n"])
+        self.assertEqual(errors, ["err\n"])
+
+    def test_iterCmd_timeout(self):
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            list(self.ktk.iterCmd("sleep 5", timeout=0.2))
+        self.assertTrue(time.time() - start < 4)
+
+    def test_readCmdAsync(self):
+        self.assertEqual(asyncio.run(self.ktk.readCmdAsync("echo Test Text")), "Test Text\n")
+        start = time.perf_counter()
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(self.ktk.readCmdAsync("sleep 5"), 0.2))  # cancelled and killed
+        self.assertTrue(time.perf_counter() - start < 4)
+
+    def test_runCmdsAsync(self):
+        start = time.perf_counter()
+        results = asyncio.run(self.ktk.runCmdsAsync(["sleep 0.3"] * 4 + ["echo Test Text", "notexist_cmd"], max_concurrency=6))
+        self.assertTrue(time.perf_counter() - start < sum(r.duration for r in results) * 0.75)  # ran in parallel
+        self.assertEqual([r.returncode for r in results], [0, 0, 0, 0, 0, 127])
+        self.assertEqual(results[4].stdout, "Test Text\n")
+
+    def test_iterCmdAsync(self):
+        async def collect():
+            return [line async for line in self.ktk.iterCmdAsync("printf 'a\\nb\\nc'")]
+        self.assertEqual(asyncio.run(collect()), ["a\n", "b\n", "c"])
+        self.assertTrue(asyncio.run(self.ktk.isCmdExistAsync("ls")))
+
     def test_getUser(self):
         self.assertEqual(self.ktk.getUser(), getpass.getuser())
 
@@ -105,6 +300,19 @@ class test_KyanToolKit(unittest.TestCase):
             self.assertFalse(self.ktk.isCmdExist("notexist"))
             self.assertTrue(self.ktk.isCmdExist("ls"))
 
+    def test_areCmdsExist(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {'PATH': tmpdir}):
+                self.assertEqual(self.ktk.areCmdsExist(["ktk_test_cmd", "ls"]), {"ktk_test_cmd": False, "ls": False})
+                filepath = os.path.join(tmpdir, "ktk_test_cmd")
+                with open(filepath, 'w') as f:
+                    f.write("#!/bin/sh\n")
+                os.chmod(filepath, 0o755)
+                self.assertTrue(self.ktk.isCmdExist("ktk_test_cmd"))  # index rebuilt when PATH dir changes
+                self.assertTrue(self.ktk.isCmdExist(filepath))
+            self.assertFalse(self.ktk.isCmdExist("ktk_test_cmd"))
+            self.assertTrue(self.ktk.isCmdExist("ls"))
+
     def test_ajax_get(self):
         url = 'https://yesno.wtf/api'
         param = {'force': 'yes'}
@@ -112,11 +320,193 @@ class test_KyanToolKit(unittest.TestCase):
         answer = result.get('answer')
         self.assertEqual(answer, 'yes')
 
+    def test_ajax_session(self):
+        encodings = []
+
+        def api(handler):
+            encodings.append(handler.headers.get('Accept-Encoding'))
+            query = urllib.parse.urlsplit(handler.path).query or FakeServer.FakeServer.readBody(handler).decode()
+            body = json.dumps({'method': handler.command, 'param': dict(urllib.parse.parse_qsl(query))}).encode()
+            if 'gzip' in handler.headers.get('Accept-Encoding', ''):
+                return 200, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}, gzip.compress(body)
+            return 200, {'Content-Type': 'application/json'}, body
+
+        with self.fakeServer() as server:
+            server.routes['api'] = api
+            server.routes['moved'] = lambda h: (301, {'Location': '/api?m=1'}, b'')
+            server.routes['found'] = lambda h: (302, {'Location': server.url('api')}, FakeServer.FakeServer.readBody(h) and b'')
+            server.routes['temporary'] = lambda h: (307, {'Location': 'api'}, FakeServer.FakeServer.readBody(h) and b'')
+            server.routes['loop'] = lambda h: (302, {'Location': 'loop'}, b'')
+            self.assertEqual(self.ktk.ajax(server.url('api'), {'a': '1'}), {'method': 'GET', 'param': {'a': '1'}})
+            with KyanToolKit.HttpSession(max_per_host=2) as session:
+                self.assertEqual(self.ktk.ajax(server.url('api'), {'a': '1'}, session=session), {'method': 'GET', 'param': {'a': '1'}})
+                self.assertEqual(self.ktk.ajax(server.url('api'), {'b': '2'}, 'post', session=session), {'method': 'POST', 'param': {'b': '2'}})
+                with patch.object(self.ktk, 'http_session', session):
+                    self.assertEqual(self.ktk.ajax(server.url('api'))['method'], 'GET')
+                with self.assertRaises(urllib.error.HTTPError):
+                    self.ktk.ajax(server.url('notexist'), session=session)
+            self.assertEqual(len(set(server.clients[1:])), 1)  # one connection reused
+            with KyanToolKit.HttpSession(gzip=False) as session:
+                self.assertEqual(self.ktk.ajax(server.url('api'), {'c': '3'}, session=session), {'method': 'GET', 'param': {'c': '3'}})
+            self.assertEqual(encodings[-1], 'identity')  # http.client default, no gzip asked
+            self.assertEqual(encodings[-2], 'gzip')
+            with KyanToolKit.HttpSession() as session:
+                for path, method, expect in (('moved', 'get', {'method': 'GET', 'param': {'m': '1'}}), ('found', 'post', {'method': 'GET', 'param': {}}), ('temporary', 'get', {'method': 'GET', 'param': {}})):
+                    self.assertEqual(self.ktk.ajax(server.url(path), {'b': '2'} if method == 'post' else None, method, session=session), expect)
+                    self.assertEqual(self.ktk.ajax(server.url(path), {'b': '2'} if method == 'post' else None, method), expect)  # same as urlopen
+                for url, method in ((server.url('loop'), 'get'), (server.url('temporary'), 'post')):  # POST is not resent by 307, as urlopen
+                    with self.assertRaises(urllib.error.HTTPError):
+                        self.ktk.ajax(url, {'b': '2'}, method, session=session)
+                getresponse = http.client.HTTPConnection.getresponse
+                calls = []
+
+                def stale(conn):  # the first response is lost after the server processed the request
+                    calls.append(conn)
+                    rsp = getresponse(conn)
+                    if len(calls) == 1:
+                        rsp.read()
+                        raise http.client.RemoteDisconnected('closed')
+                    return rsp
+
+                for method in ('POST', 'GET'):
+                    calls.clear()
+                    session.request('GET', server.url('api'))  # pool a connection
+                    del server.log[:]
+                    with patch.object(http.client.HTTPConnection, 'getresponse', stale):
+                        if method == 'POST':
+                            with self.assertRaises(http.client.RemoteDisconnected):
+                                session.request(method, server.url('api'), body=b'b=2')
+                        else:
+                            self.assertEqual(session.request(method, server.url('api')).status, 200)
+                    self.assertEqual([m for m, path, status in server.log], [method] * len(calls))
+                self.assertEqual(len(calls), 2)  # GET retried, POST was not
+
+    def test_ajax_cache(self):
+        def api(handler):
+            headers = {'Content-Type': 'application/json', 'ETag': '"v1"', 'Cache-Control': handler.path.split('cc=')[-1].replace('_', '=')}
+            if handler.headers.get('If-None-Match') == '"v1"':
+                return 304, headers, b''
+            return 200, headers, json.dumps({'path': handler.path}).encode()
+
+        with self.fakeServer() as server:
+            tmpdir = server.root
+            server.routes['api'] = api
+            cache = KyanToolKit.ResponseCache(os.path.join(tmpdir, 'cache.json'))
+            fresh = self.ktk.ajax(server.url('api'), {'cc': 'max-age_60'}, cache=cache)
+            self.assertTrue(self.ktk.ajax(server.url('api'), {'cc': 'max-age_60'}, cache=cache) is fresh)  # same dict, no parsing
+            self.assertEqual(len(server.log), 1)
+            stale = self.ktk.ajax(server.url('api'), {'cc': 'no-cache'}, cache=cache)
+            self.assertTrue(self.ktk.ajax(server.url('api'), {'cc': 'no-cache'}, cache=cache) is stale)  # revalidated
+            self.assertEqual(server.log[-1][2], 304)
+            self.ktk.ajax(server.url('api'), {'cc': 'no-store'}, cache=cache)
+            self.ktk.ajax(server.url('api'), {'cc': 'no-store'}, cache=cache)
+            self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'stale': 1, 'misses': 4, 'evictions': 0})
+            self.ktk.ajax(server.url('api'), {'cc': 'max-age_60'}, 'post', cache=cache)
+            self.assertEqual(server.log[-1][0], 'POST')
+            cache.save()
+            with KyanToolKit.HttpSession() as session:
+                reloaded = KyanToolKit.ResponseCache(cache.path)
+                self.assertEqual(self.ktk.ajax(server.url('api'), {'cc': 'max-age_60'}, cache=reloaded, session=session), fresh)
+                self.assertEqual(self.ktk.ajax(server.url('api'), {'cc': 'no-cache'}, cache=reloaded, session=session), stale)
+            self.assertEqual(reloaded.stats()['hits'], 1)
+            self.assertEqual(server.log[-1][2], 304)
+
+    def test_ajaxBatch(self):
+        attempts = collections.Counter()
+
+        def api(handler):
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(handler.path).query or FakeServer.FakeServer.readBody(handler).decode()))
+            attempts[query['id']] += 1
+            time.sleep(float(query.get('sleep', 0)))
+            if attempts[query['id']] <= int(query.get('fail', 0)):
+                return 503, {}, b''
+            return 200, {'Content-Type': 'application/json'}, json.dumps(query).encode()
+
+        with self.fakeServer() as server:
+            server.routes['api'] = api
+            specs = [(server.url('api'), {'id': str(i), 'sleep': '0.2'}) for i in range(8)]
+            start = time.perf_counter()
+            self.ktk.ajaxBatch(specs[:1])
+            single = time.perf_counter() - start
+            start = time.perf_counter()
+            results = self.ktk.ajaxBatch(specs, max_workers=8, per_host=8)
+            self.assertTrue(time.perf_counter() - start < len(specs) * single * 0.5)  # in parallel
+            self.assertEqual([r['id'] for r in results], [str(i) for i in range(8)])
+            specs = [(server.url('api'), {'id': 'retry', 'fail': '2'}), server.url('notexist'), (server.url('api'), {'id': 'post'}, 'post')]
+            results = self.ktk.ajaxBatch(specs, retries=2, backoff=0.01)
+            self.assertEqual(results[0]['id'], 'retry')
+            self.assertTrue(isinstance(results[1], urllib.error.HTTPError))
+            self.assertEqual(attempts['retry'], 3)
+            post = (server.url('api'), {'id': 'post_retry', 'fail': '1'}, 'post')
+            self.assertTrue(isinstance(self.ktk.ajaxBatch([post], backoff=0.01)[0], urllib.error.HTTPError))  # POST is not retried by default
+            self.assertEqual(self.ktk.ajaxBatch([post], backoff=0.01, retry_post=True)[0]['id'], 'post_retry')
+            self.assertEqual(attempts['post_retry'], 2)
+            start = time.perf_counter()
+            indexes = [i for i, r in self.ktk.ajaxBatchIter([(server.url('api'), {'id': 'rate'})] * 5, rate=20)]
+            self.assertEqual(sorted(indexes), list(range(5)))
+            self.assertTrue(time.perf_counter() - start >= 0.15)
+
+    def test_ajaxStream(self):
+        records = [{'id': i, 'text': '文本' * (i % 7)} for i in range(2000)] + [12345, "s", None]
+
+        def ndjson(handler):
+            return 200, {'Content-Type': 'application/x-ndjson'}, (json.dumps(r, ensure_ascii=False).encode() + b'\n' for r in records)
+
+        def array(handler):
+            chunks = ((b'[' if i == 0 else b', ') + json.dumps(r, ensure_ascii=False).encode() for i, r in enumerate(records))
+            return 200, {'Content-Type': 'application/json'}, itertools.chain(chunks, [b' ]'])
+
+        with self.fakeServer() as server:
+            server.routes.update({'ndjson': ndjson, 'array': array})
+            self.assertEqual(list(self.ktk.ajaxStream(server.url('ndjson'), chunk_size=7)), records)
+            self.assertEqual(list(self.ktk.ajaxStream(server.url('array'), chunk_size=7)), records)
+            self.assertEqual(list(self.ktk.ajaxStream(server.url('array'), format_='array')), records)
+        self.assertEqual(list(self.ktk._iterJson(['[', ']'])), [])
+        self.assertEqual(list(self.ktk._iterJson(['1', '2\n3'])), [12, 3])
+        with self.assertRaises(ValueError):
+            list(self.ktk._iterJson(['[{"a": ', '1']))
+        big = json.dumps({'items': ['x' * 100] * 2000}) + '\n7'
+        with patch.object(json.JSONDecoder, 'raw_decode', autospec=True, side_effect=json.JSONDecoder.raw_decode) as raw_decode:
+            self.assertEqual(list(self.ktk._iterJson(big[i:i + 100] for i in range(0, len(big), 100))), [json.loads(big.split('\n')[0]), 7])
+        self.assertTrue(raw_decode.call_count < 30)  # not decoded again for each of the ~2000 chunks
+
     def test_readFile(self):
         filepath = os.path.join(ktk_dir, 'tests', 'test_KyanToolKit.py')
         content = self.ktk.readFile(filepath)
         self.assertTrue(content is not None)
 
+    def test_readFile_encodings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cases = {
+                'utf8': ('中文\r\nline2\n', 'utf-8', 'utf-8'),
+                'gbk': ('中文\nline2\n' * 20000, 'gbk', 'gbk'),
+                'cp1252': ('caf\xe9 \u20ac\n', 'cp1252', 'cp1252'),
+                'utf16': ('中文\n', 'utf-16', 'utf-16'),
+                'bom': ('中文\n', 'utf-8-sig', 'utf-8-sig'),
+            }
+            for name, (text, codec, expect) in cases.items():
+                filepath = os.path.join(tmpdir, name)
+                with open(filepath, 'wb') as f:
+                    f.write(text.encode(codec))
+                self.assertEqual(self.ktk.detectEncoding(filepath), expect)
+                self.assertEqual(self.ktk.readFile(filepath), text.replace('\r\n', '\n'))
+                self.assertEqual(self.ktk.readFile(filepath, encoding=expect), text.replace('\r\n', '\n'))
+                self.assertEqual(''.join(self.ktk.readFileLines(filepath)), text.replace('\r\n', '\n'))
+            filepaths = [os.path.join(tmpdir, name) for name in cases]
+            self.assertEqual(list(self.ktk.readFiles(filepaths).values()), [self.ktk.readFile(fl) for fl in filepaths])
+            for name, data, expect in (
+                ('badbom16', b'\xff\xfeabc', 'cp1252'),  # BOM codec fails, fall back
+                ('badbom8', b'\xef\xbb\xbfcaf\xe9', 'cp1252'),
+                ('late', b'a' * 70000 + 'caf\xe9'.encode('cp1252'), 'cp1252'),  # beyond the detected prefix
+            ):
+                filepath = os.path.join(tmpdir, name)
+                with open(filepath, 'wb') as f:
+                    f.write(data)
+                self.assertEqual(self.ktk.readFile(filepath, with_encoding=True), (data.decode(expect), expect))
+            self.assertEqual(self.ktk.detectEncoding(filepath), 'utf-8')
+            with self.assertRaises(UnicodeDecodeError):
+                self.ktk.readFile(filepath, encoding='utf-8')
+
     def test_updateFile(self):
         url = 'https://raw.githubusercontent.com/kyan001/PyKyanToolKit/master/tests/testfile'
         filepath = os.path.join(ktk_dir, 'tests', 'testfile')
@@ -125,6 +515,135 @@ class test_KyanToolKit(unittest.TestCase):
         self.assertFalse(result)
         self.assertTrue(expect in self.fakeout.readline())
 
+    def test_updateFile_local(self):
+        with self.fakeServer() as server:
+            tmpdir = server.root
+            remote, local = os.path.join(tmpdir, 'remote'), os.path.join(tmpdir, 'local')
+            for fl, content in ((remote, b'Test Text\n'), (local, b'Test Text\r\n')):
+                with open(fl, 'wb') as f:
+                    f.write(content)
+            os.chmod(local, 0o751)
+            self.assertFalse(self.ktk.updateFile(local, server.url('remote'), conditional=True))
+            self.assertTrue(os.path.exists(local + '.http.json'))
+            self.assertFalse(self.ktk.updateFile(local, server.url('remote'), conditional=True))
+            self.assertEqual(server.log[-1][2], 304)
+            with open(remote, 'wb') as f:
+                f.write(b'Test Text Changed\n')
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, conditional=True))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), b'Test Text Changed\n')
+            self.assertEqual(os.stat(local).st_mode & 0o777, 0o751)
+            self.assertFalse(self.ktk.updateFile(local, server.url('remote'), conditional=True))
+            self.assertEqual(server.log[-1][2], 304)
+            self.assertFalse(self.ktk.updateFile(local, server.url('notexist'), interactive=False))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['local', 'local.http.json', 'remote'])  # no temp files left
+
+    def test_updateFile_delta(self):
+        with self.fakeServer() as server:
+            tmpdir = server.root
+            rnd = random.Random(1)
+            content = bytes(rnd.getrandbits(8) for _ in range(100000))
+            remote, local = os.path.join(tmpdir, 'remote'), os.path.join(tmpdir, 'local')
+            with open(remote, 'wb') as f:
+                f.write(content)
+            with open(local, 'wb') as f:
+                f.write(content[:30000] + b'inserted' + content[30000:60000] + content[61000:])
+            signature = self.ktk.makeBlockSignature(remote, block_size=4096)
+            self.assertEqual(signature['hash'], self.ktk.md5(content))
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, delta=True))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            statuses = [status for method, path, status in server.log if path == '/remote']
+            self.assertEqual(set(statuses), {206})
+            self.assertEqual(len(statuses), 2)  # only blocks with changes are fetched
+            self.assertFalse(self.ktk.updateFile(local, server.url('remote'), delta=True))
+            os.remove(remote + '.blocks')
+            with open(local, 'wb') as f:
+                f.write(b'old')
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, delta=True))  # no signature, full download
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.ktk.makeBlockSignature(remote, block_size=4096)
+            with open(local, 'wb') as f:  # changed in place: the scan jumps ahead, later blocks are found at their offsets
+                f.write(bytes(20000) + content[20000:60000] + bytes(100) + content[60100:])
+            del server.log[:]
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, delta=True))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual([status for method, path, status in server.log if path == '/remote'], [206, 206])
+            with open(local, 'wb') as f:  # extra data longer than the probe window, the rest is shifted
+                f.write(content[:50000] + bytes(rnd.getrandbits(8) for _ in range(30000)) + content[50000:])
+            del server.log[:]
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, delta=True))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual([status for method, path, status in server.log if path == '/remote'], [206])  # only the split block
+            big = rnd.getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'little')
+            with open(remote, 'wb') as f:
+                f.write(big)
+            signature = self.ktk.makeBlockSignature(remote, block_size=4096)
+            with open(local, 'wb') as f:
+                f.write(big[::-1])
+            durations = []
+            for give_up in (None, 2):  # nothing matches: a full scan against jumping ahead
+                start = time.perf_counter()
+                tmp, raw_md5, raw_size = self.ktk._deltaDownload(local, server.url('remote'), signature, give_up=give_up)
+                durations.append(time.perf_counter() - start)
+                os.remove(tmp)
+                self.assertEqual((raw_md5, raw_size), (self.ktk.md5(big), len(big)))
+            self.assertTrue(durations[1] < durations[0] * 0.5)
+            self.assertTrue(self.ktk.updateFile(local, server.url('remote'), interactive=False, delta=True))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), big)
+
+    def test_updateFiles(self):
+        with tempfile.TemporaryDirectory() as local, self.fakeServer() as server:
+            remote = server.root
+            files = {'same': b'a', 'changed': b'b2', 'sub/new': b'c', 'deep/er/new': b'd'}
+            for path, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(remote, path)), exist_ok=True)
+                with open(os.path.join(remote, path), 'wb') as f:
+                    f.write(content)
+            for path, content in (('same', b'a'), ('changed', b'b1')):
+                with open(os.path.join(local, path), 'wb') as f:
+                    f.write(content)
+            os.chmod(os.path.join(local, 'changed'), 0o755)
+            manifest = {'algorithm': 'sha256', 'files': {p: {'hash': hashlib.sha256(c).hexdigest(), 'size': len(c)} for p, c in files.items()}}
+            manifest['files']['broken'] = 'notahash'
+            with open(os.path.join(remote, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            summary = self.ktk.updateFiles(server.url('manifest.json'), local, retries=0, atomic=True)
+            self.assertEqual(summary['unchanged'], ['same'])
+            self.assertEqual(sorted(summary['skipped']), ['changed', 'deep/er/new', 'sub/new'])
+            self.assertEqual(list(summary['failed']), ['broken'])
+            self.assertFalse(os.path.exists(os.path.join(local, 'sub')))  # no directory left behind
+            del manifest['files']['broken']
+            with open(os.path.join(remote, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            with open(os.path.join(local, 'sub'), 'wb') as f:  # a file where a directory is needed
+                f.write(b'not a dir')
+            summary = self.ktk.updateFiles(server.url('manifest.json'), local, retries=0, atomic=True)
+            self.assertEqual(list(summary['failed']), ['sub/new'])
+            self.assertEqual(sorted(summary['skipped']), ['changed', 'deep/er/new'])
+            self.assertEqual(sorted(os.listdir(local)), ['changed', 'same', 'sub'])  # nothing moved, no directory or temp file left
+            del server.log[:]
+            summary = self.ktk.updateFiles(server.url('manifest.json'), local, retries=2)
+            self.assertEqual(list(summary['failed']), ['sub/new'])
+            self.assertEqual(sorted(summary['updated']), ['changed', 'deep/er/new'])
+            self.assertEqual(len([path for method, path, status in server.log if path == '/sub/new']), 1)  # not downloaded again
+            self.assertEqual(sorted(os.listdir(local)), ['changed', 'deep', 'same', 'sub'])
+            os.remove(os.path.join(local, 'sub'))
+            summary = self.ktk.updateFiles(server.url('manifest.json'), local)
+            self.assertEqual(sorted(summary['updated']), ['sub/new'])
+            for path, content in files.items():
+                with open(os.path.join(local, path), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(os.stat(os.path.join(local, 'changed')).st_mode & 0o777, 0o755)  # mode kept
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(os.path.join(local, 'sub', 'new')).st_mode & 0o777, 0o666 & ~umask)
+            self.assertEqual(self.ktk.updateFiles(server.url('manifest.json'), local)['updated'], [])
+
     def test_getDir(self):
         dirname, basename = self.ktk.getDir(__file__)
         self.assertTrue(dirname.endswith('tests'))
@@ -203,6 +722,62 @@ class test_KyanToolKit(unittest.TestCase):
         for li in expect_diff_partial:
             self.assertTrue(li in self.ktk.diff(a, b, force_str=True))
 
+    def test_diff_patience(self):
+        testfile = os.path.join(ktk_dir, 'tests', 'testfile')
+        testfile2 = os.path.join(ktk_dir, 'tests', 'testfile2')
+        cases = [
+            ("test", "test"), ("test1", "test2"), (["a", "c"], ["b", "c"]), (testfile, testfile2), (testfile, "This file should not changed too"),
+            ("a\nb\nc\nd\ne\nf\ng\nh", "a\nB\nc\nd\ne\nf\ng\nH\ni"), ("", "a\nb"), ("a\nb", ""),
+        ]
+        for a, b in cases:
+            for context in (0, 1, 3):
+                self.assertEqual(self.ktk.diff(a, b, context=context, engine='patience'), self.ktk.diff(a, b, context=context))
+
+    def test_diff_patience_blocks(self):
+        rnd = random.Random(1)
+        for _ in range(50):
+            a = [rnd.choice("abcdefg}") for _ in range(rnd.randint(0, 60))]
+            b = [rnd.choice("abcdefgh}") for _ in range(rnd.randint(0, 60))]
+            i_end = j_end = 0
+            for i, j, size in self.ktk._patienceBlocks(a, b):
+                self.assertTrue(i >= i_end and j >= j_end and size > 0)
+                self.assertEqual(a[i:i + size], b[j:j + size])
+                i_end, j_end = i + size, j + size
+            diffs = self.ktk.diff(a, b, engine='patience')
+            self.assertEqual(bool(diffs), a != b)
+            self.assertEqual(len([ln for ln in diffs[2:] if ln.startswith('+')]) - len([ln for ln in diffs[2:] if ln.startswith('-')]), len(b) - len(a))
+
+    def test_hasDiff(self):
+        testfile = os.path.join(ktk_dir, 'tests', 'testfile')
+        testfile2 = os.path.join(ktk_dir, 'tests', 'testfile2')
+        self.assertTrue(self.ktk.hasDiff(testfile, testfile2))
+        self.assertFalse(self.ktk.hasDiff(testfile, testfile))
+        self.assertTrue(self.ktk.hasDiff(testfile, "This file should not changed too"))
+        self.assertTrue(self.ktk.hasDiff("test1", "test2"))
+        self.assertFalse(self.ktk.hasDiff(["a"], ["a"]))
+        self.assertFalse(self.ktk.hasDiff("a\nb", ["a", "b"]))  # str is compared by lines, like diff()
+        self.assertEqual(self.ktk.diff("a\nb", ["a", "b"]), [])
+        self.assertTrue(self.ktk.hasDiff(["a", "b"], "a\nc"))
+
+    def test_diffDirs(self):
+        with tempfile.TemporaryDirectory() as dir1, tempfile.TemporaryDirectory() as dir2:
+            files1 = {'same': 'a\n', 'touched': 'b\n', 'changed': 'c\n', 'removed': 'd\n', os.path.join('sub', 'changed'): 'e\n', os.path.join('gone', 'f'): 'f\n'}
+            files2 = {'same': 'a\n', 'touched': 'b\n', 'changed': 'C\n', 'added': 'g\n', os.path.join('sub', 'changed'): 'e\ne\n'}
+            for root, files in ((dir1, files1), (dir2, files2)):
+                for name, content in files.items():
+                    os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+                    with open(os.path.join(root, name), 'w') as f:
+                        f.write(content)
+                os.utime(os.path.join(root, 'same'), ns=(0, 0))
+            with patch("sys.stdin", new=self.console_in):  # child processes close stdin
+                results = list(self.ktk.diffDirs(dir1, dir2, max_workers=2, max_pending=2))
+        self.assertEqual([(status, path) for status, path, diffs in results], [
+            ('added', 'added'), ('changed', 'changed'), ('removed', os.path.join('gone', 'f')),
+            ('removed', 'removed'), ('changed', os.path.join('sub', 'changed'))
+        ])
+        self.assertEqual(results[1][2], ['--- changed', '+++ changed', '@@ -1 +1 @@', '-c', '+C'])
+        self.assertEqual(results[4][2][2:], ['@@ -1,0 +2 @@', '+e'])
+
     def test_needPlatform(self):
         self.ktk.needPlatform(sys.platform)
         expect_word_need = "Need: {0}".format(sys.platform)
@@ -241,6 +816,99 @@ class test_KyanToolKit(unittest.TestCase):
         if not old_trace_exist:
             os.remove(fl)
 
+    def test_inTrace_profile(self):
+        inst = KyanToolKit.KyanToolKit(os.path.join(tempfile.gettempdir(), 'ktk_never_written.xml'), profile=True)
+
+        @inst.inTrace
+        def inTrace():
+            time.sleep(0.001)
+
+        for i in range(5):
+            inTrace()
+        self.assertFalse(os.path.exists(inst.trace_file))
+        report = inst.profileReport(reset=True)
+        stat = report[inTrace.__qualname__]
+        self.assertEqual(stat['count'], 5)
+        self.assertTrue(stat['min'] >= 0.001)
+        self.assertTrue(stat['min'] <= stat['avg'] <= stat['max'])
+        self.assertEqual(sum(stat['histogram'].values()), 5)
+        self.assertEqual(inst.profileReport(), {})
+        inst.sample_rate = 0
+        inTrace()
+        self.assertEqual(inst.profileReport(), {})
+
+    def test_TRACE_buffered(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            direct = KyanToolKit.KyanToolKit(os.path.join(tmpdir, 'direct.xml'))
+            buffered = KyanToolKit.KyanToolKit(os.path.join(tmpdir, 'buffered.xml'), buffered=True)
+            for i in range(100):
+                direct.TRACE("Test Text {}".format(i))
+                buffered.TRACE("Test Text {}".format(i))
+            buffered.flush()
+            contents = []
+            for inst in (direct, buffered):
+                with open(inst.trace_file, 'rb') as f:
+                    contents.append(re.sub(rb'TIME="[^"]*"', b'', f.read()))
+            buffered.close()
+            self.assertFalse(buffered.trace_writer._thread.is_alive())
+            self.assertEqual(contents[0], contents[1])
+            self.assertEqual(buffered.trace_writer.dropped, 0)
+            buffered.TRACE("After Close")  # written directly, no error
+            with open(buffered.trace_file) as f:
+                self.assertTrue(f.read().endswith("After Close\n</INFO>\n"))
+
+    def test_TRACE_jsonl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            f = os.path.join(tmpdir, 'trace.jsonl')
+            inst = KyanToolKit.KyanToolKit(f, trace_format='jsonl')
+
+            def first():
+                inst.TRACE("Test Text 1")
+
+            def second():
+                inst.TRACE("Test Text 2")
+
+            first()
+            second()
+            first()
+            reader = KyanToolKit.TraceReader(f)
+            self.assertEqual(reader.index(), 3)
+            self.assertEqual([r['content'] for r in reader.query(func='first')], ["Test Text 1"] * 2)
+            self.assertEqual(len(list(reader.query(end=0))), 0)
+            second()
+            self.assertEqual(len(list(reader.query(func='second'))), 2)
+            self.assertTrue(os.path.exists(reader.index_file))
+            self.assertEqual(KyanToolKit.TraceReader(f).index(), 4)  # loaded from sidecar index
+            code = 'import KyanToolKit; KyanToolKit.KyanToolKit({0!r}, trace_format="jsonl").TRACE("\\u6d4b\\u8bd5"); KyanToolKit.KyanToolKit({0!r}, buffered=True, trace_format="jsonl").TRACE("\\u4e2d\\u6587")'.format(f)
+            env = dict(os.environ, LC_ALL='C', PYTHONCOERCECLOCALE='0', PYTHONUTF8='0')  # ASCII locale encoding
+            proc = subprocess.run([sys.executable, '-c', code], cwd=ktk_dir, env=env, capture_output=True)
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertEqual([r['content'] for r in reader.query()][-2:], ["测试", "中文"])  # written as UTF-8
+
+    def test_TRACE_rotate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            f = os.path.join(tmpdir, 'trace.xml')
+            inst = KyanToolKit.KyanToolKit(f, max_bytes=300, backup_count=2)
+            for i in range(10):
+                inst.TRACE("Test Text {}".format(i))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['trace.xml', 'trace.xml.1', 'trace.xml.2'])
+            self.assertTrue(os.path.getsize(f) <= 300)
+
+    def test_bench_compare(self):
+        import bench_KyanToolKit
+        baseline = {'a': {'best': 0.010}, 'b': {'best': 0.010}, 'c': {'best': 0.00001}}
+        results = {'a': {'best': 0.012}, 'b': {'best': 0.020}, 'c': {'best': 0.0001}, 'new': {'best': 1.0}}
+        self.assertEqual(bench_KyanToolKit.compare(results, baseline, threshold=0.5), [('b', 0.010, 0.020)])  # 'c' is under min_delta
+
+    def test_import_time(self):
+        heavy = ['consoleiotools', 'urllib.request', 'http.client', 'subprocess', 'asyncio', 'json', 'hashlib', 'difflib', 'concurrent.futures', 'email.utils']
+        code = 'import sys, KyanToolKit; print(" ".join(m for m in {!r} if m in sys.modules))'.format(heavy)
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ktk_dir, capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(proc.stdout.strip(), '')  # heavy modules are imported on first use
+        cumulative = [int(line.split('|')[1]) for line in proc.stderr.splitlines() if line.split('|')[-1].strip() == 'KyanToolKit']
+        self.assertTrue(cumulative[0] < 250000, '{} us'.format(cumulative[0]))  # budget: 250 ms
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2, exit=False)  # print more info, no sys.exit() called.